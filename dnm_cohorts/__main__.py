@@ -1,13 +1,16 @@
 
-import itertools
 import argparse
+import contextlib
+import heapq
+import io
+import tempfile
 import trio
 import sys
 import os
 import logging
-from itertools import groupby
 
-from dnm_cohorts.ensembl import get_consequences
+from dnm_cohorts.ensembl import (get_consequences, use_sequence_cache,
+    use_sequence_provider, sequence_providers, set_base_url)
 from dnm_cohorts.cohorts import (
     open_de_ligt_cohort,
     open_rauch_cohort,
@@ -52,9 +55,29 @@ from dnm_cohorts.de_novos import (
     fu_nature_genetics_de_novos,
     )
 from dnm_cohorts.convert_pdf_table import flatten
-from dnm_cohorts.exclude_duplicates import drop_inperson_duplicates
+from dnm_cohorts.exclude_duplicates import (drop_inperson_duplicates,
+    merge_duplicate_dnms)
 from dnm_cohorts.de_novo import DeNovo
+from dnm_cohorts.external_sort import spill_run, merge_runs, chunk_by_person
+from dnm_cohorts.incremental import MergedDataset, write_changes
+from dnm_cohorts.open_data import open_de_novos, open_cohort
 from dnm_cohorts.rate_limiter import RateLimiter
+from dnm_cohorts.request_metrics import Metrics
+from dnm_cohorts.sequence_cache import SequenceCache
+from dnm_cohorts.fasta import IndexedFasta
+from dnm_cohorts.gtf_annotator import GtfAnnotator, annotate_offline
+from dnm_cohorts.vep_cache import VepCache
+from dnm_cohorts.sample_identity import (find_sample_aliases, write_aliases,
+    read_aliases, alias_map, rename_aliases)
+
+# request metrics, shared by every RateLimiter in a run
+metrics = Metrics()
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+    return value
 
 def get_options():
     parser = argparse.ArgumentParser(add_help=False)
@@ -63,16 +86,103 @@ def get_options():
         default=sys.stdout, help='where to save output')
     parser.add_argument('--log', type=argparse.FileType('wt'),
         default=sys.stderr, help='where to write log output')
+    parser.add_argument('--processes', type=int, default=1,
+        help='number of processes to use when merging duplicate variants')
+    parser.add_argument('--vep-batch-size', type=int, default=200,
+        help='number of variants per VEP POST request. Use 0 to annotate ' \
+             'variants one at a time.')
+    parser.add_argument('--vep-workers', type=positive_int, default=50,
+        help='number of simultaneous VEP requests')
+    parser.add_argument('--vep-cache',
+        help='path to SQLite cache of VEP annotations, so reruns only query ' \
+             'Ensembl for new variants')
+    parser.add_argument('--vep-cache-days', type=float, default=90,
+        help='days before cached VEP annotations expire')
+    parser.add_argument('--vep-cache-size', type=int, default=5000000,
+        help='maximum number of variants to keep in the VEP cache')
+    parser.add_argument('--sequence-cache',
+        help='path to SQLite cache of reference sequence, for allele fixing')
+    parser.add_argument('--sequence-cache-size', type=int, default=1000000,
+        help='maximum number of sequence windows to keep in the cache')
+    parser.add_argument('--sequence-cache-bases', type=int, default=250000000,
+        help='maximum total length of sequence to keep in the cache')
+    parser.add_argument('--fasta', action='append', default=[],
+        metavar='BUILD=PATH',
+        help='indexed reference FASTA for a genome build (e.g. ' \
+             'grch37=hs37d5.fa), used instead of Ensembl for reference ' \
+             'sequence. Can be given once per build.')
+    parser.add_argument('--annotator', choices=['vep', 'gtf'], default='vep',
+        help='annotate consequences via the Ensembl VEP REST API, or offline ' \
+             'from local transcript models (see --gtf)')
+    parser.add_argument('--gtf', action='append', default=[],
+        metavar='BUILD=PATH',
+        help='GTF of transcripts for a genome build (e.g. ' \
+             'grch37=Homo_sapiens.GRCh37.87.gtf.gz), for --annotator gtf. ' \
+             'Coding changes also need --fasta for the same build.')
+    parser.add_argument('--ensembl-url',
+        help='base URL of the REST server to use instead of Ensembl, e.g. a ' \
+             'mock server from "python -m dnm_cohorts.mock_ensembl"')
+    parser.add_argument('--metrics', type=argparse.FileType('wt'),
+        help='where to save request metrics (counts, bytes, status codes, ' \
+             'retries and timings per endpoint) as JSON, at the end of the run')
+    parser.add_argument('--retry-ratio', type=float, default=0.2,
+        help='retries allowed as a fraction of requests, shared by every ' \
+             'request, so an outage doesn\'t multiply the request rate')
+    parser.add_argument('--breaker-threshold', type=float, default=0.5,
+        help='fraction of recent requests to a host which must fail before ' \
+             'requests to the host pause')
+    parser.add_argument('--breaker-window', type=positive_int, default=20,
+        help='number of recent requests to a host checked for failures')
+    parser.add_argument('--breaker-cooldown', type=float, default=5,
+        help='seconds to pause requests to a failing host, before probing ' \
+             'it again. This doubles after each failed probe.')
+    parser.add_argument('--breaker-max-pause', type=float, default=900,
+        help='seconds a host can fail for before its requests fail fast')
+    parser.add_argument('--aliases', type=argparse.FileType('rt'),
+        help='table of the same samples under different IDs in different ' \
+             'studies (from the sample-aliases command). Aliased persons are ' \
+             'merged into one person.')
     
     subparsers = parser.add_subparsers()
     de_novos = subparsers.add_parser('de-novos', parents=[parser],
         description='Gets de novo mutations from publically available datasets.')
+    de_novos.add_argument('--external-sort', metavar='DIR',
+        help='merge variants via sorted runs spilled to disk in this folder, ' \
+             'rather than holding every variant in memory')
     de_novos.set_defaults(func=get_de_novos)
     
+    aliases = subparsers.add_parser('sample-aliases', parents=[parser],
+        description='Finds samples present in multiple studies under ' \
+            'different IDs, from shared de novo calls')
+    aliases.set_defaults(func=get_sample_aliases)
+    
     cohort = subparsers.add_parser('cohort', parents=[parser],
         description='Gets cohort info for de novo datasets')
     cohort.set_defaults(func=get_cohorts)
     
+    adder = subparsers.add_parser('add-study', parents=[parser],
+        description='Adds one new study to a previously built dataset, ' \
+            'without reloading every other study')
+    adder.add_argument('--index', required=True,
+        help='path to SQLite index of the previously built dataset. This is ' \
+            'built from --existing-de-novos and --existing-cohort if it ' \
+            'doesn\'t exist yet, and is updated with the new study, so later ' \
+            'studies can be added from the index alone.')
+    adder.add_argument('--existing-de-novos',
+        help='path to previously built de novos (gzipped)')
+    adder.add_argument('--existing-cohort',
+        help='path to previously built cohort (gzipped)')
+    adder.add_argument('--de-novos', required=True,
+        help='path to de novos for the new study, in the same format. ' \
+             'Variants without a consequence are annotated via Ensembl.')
+    adder.add_argument('--cohort', required=True,
+        help='path to persons in the new study, in the cohort format')
+    adder.add_argument('--output-cohort', type=argparse.FileType('wt'),
+        required=True, help='where to save the merged cohort')
+    adder.add_argument('--changes', type=argparse.FileType('wt'),
+        default=sys.stderr, help='where to report changed records')
+    adder.set_defaults(func=add_study)
+    
     lifter = subparsers.add_parser('lift', parents=[parser],
         description='Converts de novo mutations to a different genome build')
     lifter.add_argument('--input', type=argparse.FileType('rt'),
@@ -84,24 +194,90 @@ def get_options():
     
     return parser.parse_args()
 
+def open_vep_cache(args):
+    ''' open the VEP cache, if one was requested
+    '''
+    if args.vep_cache is None:
+        return None
+    return VepCache(args.vep_cache, ttl=args.vep_cache_days * 24 * 3600,
+        max_entries=args.vep_cache_size)
+
+def open_limiter(args):
+    ''' get a RateLimiter for the Ensembl REST API, with the retry options
+    '''
+    return RateLimiter(14, metrics=metrics, retry_ratio=args.retry_ratio,
+        breaker_threshold=args.breaker_threshold,
+        breaker_window=args.breaker_window,
+        breaker_cooldown=args.breaker_cooldown,
+        breaker_max_pause=args.breaker_max_pause)
+
+def open_annotators(args):
+    ''' load the transcript models for offline annotation, if requested
+    
+    Returns:
+        dict of GtfAnnotator for each genome build, or None if annotating via
+        the VEP REST API
+    '''
+    if args.annotator != 'gtf':
+        return None
+    if len(args.gtf) == 0:
+        raise ValueError('--annotator gtf needs a GTF, via --gtf BUILD=PATH')
+    
+    annotators = {}
+    for x in args.gtf:
+        build, path = x.split('=', 1)
+        annotators[build] = GtfAnnotator(path, sequence_providers.get(build))
+    return annotators
+
+async def annotate(limiter, variants, args, cache, annotators, processes=1):
+    ''' annotate variant consequences and symbols, with the chosen annotator
+    '''
+    if annotators is None:
+        return await get_consequences(limiter, variants, args.vep_batch_size,
+            cache, args.vep_workers)
+    
+    missing = annotate_offline(annotators, variants, processes)
+    if len(missing) > 0:
+        logging.warning(f'{len(missing)} variants have no local transcript ' \
+            'models for their build, annotating via VEP')
+        await get_consequences(limiter, missing, args.vep_batch_size, cache,
+            args.vep_workers)
+    return variants
+
 def merge_duplicate_persons(person_lists):
     ''' merge duplicate persons
+    
+    Persons are indexed in a single pass over every cohort. The first time a
+    person is seen they are kept (in the list they came from), and the
+    phenotypes and studies of any later copies are merged into that person.
+    
+    Returns:
+        list of sets of persons, one per input list, where each person only
+        occurs in the first list which included them.
     '''
-    # convert to dicts to be able to set new merged persons
-    person_lists = [dict(zip(x, x)) for x in person_lists]
-    for a, b in itertools.combinations(person_lists, 2):
-        for x in set(a) & set(b):
-            x.phenotype = sorted(set(a[x].phenotype + b[x].phenotype))
-            x.studies = sorted(set(a[x].studies + b[x].studies))
-            del a[x]
-            del b[x]
-            a[x] = x
-    
-    person_lists = [set(x) for x in person_lists]
-    for a, b in itertools.combinations(person_lists, 2):
-        a -= b
-    
-    return person_lists
+    first = {}
+    merged = {}
+    unique = [set() for _ in person_lists]
+    for i, persons in enumerate(person_lists):
+        for x in persons:
+            if x not in first:
+                first[x] = x
+                unique[i].add(x)
+                continue
+            
+            if x not in merged:
+                kept = first[x]
+                merged[x] = (set(kept.phenotype), set(kept.studies))
+            phenotypes, studies = merged[x]
+            phenotypes.update(x.phenotype)
+            studies.update(x.studies)
+    
+    for x, (phenotypes, studies) in merged.items():
+        kept = first[x]
+        kept.phenotype = sorted(phenotypes)
+        kept.studies = sorted(studies)
+    
+    return unique
 
 async def get_cohorts(args):
     ''' get list of all individuals in all cohorts
@@ -132,37 +308,87 @@ async def get_cohorts(args):
         open_halldorsson_science_cohort(),
         ]
     
+    if args.aliases is not None:
+        mapping = alias_map(read_aliases(args.aliases))
+        samples = [set(rename_aliases(x, mapping)) for x in samples]
+    
     samples = merge_duplicate_persons(samples)
     for x in flatten(samples):
         yield str(x) + '\n'
 
-def merge_duplicate_dnms(cohorts):
-    """ only include unique variants
-    """
+# de novo loaders, in priority order. Where a variant is in multiple studies,
+# the variant from the study listed first is kept. Each entry gives the study
+# key, the loader function, and whether the loader uses the Ensembl API.
+ASD_LOADERS = [
+    ('sanders_neuron', sanders_neuron_de_novos, False),
+    ('de_rubeis_nature', de_rubeis_nature_de_novos, False),
+    ('iossifov_nature', iossifov_nature_de_novos, False),
+    ('iossifov_neuron', iossifov_neuron_de_novos, True),
+    ('oroak_nature', oroak_nature_de_novos, True),
+    ('sanders_nature', sanders_nature_de_novos, True),
+    ('an_science', an_science_de_novos, False),
+    ('yuen_nature_neuroscience', yuen_nature_neuroscience_de_novos, False),
+    ('fu_nature_genetics', fu_nature_genetics_de_novos, False),
+    ]
+NON_ASD_LOADERS = [
+    ('de_ligt_nejm', de_ligt_nejm_de_novos, True),
+    ('gilissen_nature', gilissen_nature_de_novos, True),
+    ('epi4k_ajhg', epi4k_ajhg_de_novos, True),
+    ('jin_nature_genetics', jin_nature_genetics_de_novos, False),
+    ('rauch_lancet', rauch_lancet_de_novos, True),
+    ('kaplanis_nature', kaplanis_nature_de_novos, True),
+    ('halldorsson_science', halldorsson_science_de_novos, False),
+    ]
+
+async def run_loader(loader, results, key, spill_dir, aliases, *args):
+    ''' run a de novo loader, and optionally spill its variants to disk
     
-    unique = set()
-    for _id, group in groupby(sorted(flatten(cohorts), key=lambda x: x.person_id), key=lambda x: x.person_id):
-        # within variants for an individual, check to see if any are the same
-        # variant by seeing if any already included overlap the same range.
-        # We can't just check for inclusion inside the set, as that would use
-        # the position, not the range.
-        shrunken = set()
-        for var in group:
-            # can't use "var in shrunken", since that only checks exact pos
-            if any(var == x for x in shrunken):
-                studies = [var.study]
-                for x in shrunken:
-                    if var == x:
-                        studies += x.study.split(',')
-                        studies = ','.join(sorted(set(studies)))
-                        var.study = studies
-                        break
-                shrunken = set(x for x in shrunken if x != var)
-            shrunken.add(var)
-        
-        unique |= shrunken
+    Args:
+        loader: async function which appends a set of DeNovos to a list
+        results: dict to store the variants (or a path to the sorted run) in,
+            under the study key
+        key: key for the study
+        spill_dir: folder to write a sorted run to, or None to keep the
+            variants in memory
+        aliases: dict for renaming person IDs, or None
+        args: additional arguments for the loader
+    '''
+    variants = []
+    await loader(variants, *args)
+    variants = flatten(variants)
+    if aliases:
+        variants = rename_aliases(variants, aliases)
     
-    return unique
+    # loaders return sets, so put variants in a fixed order
+    variants = sorted(variants, key=lambda x: (x.person_id, x.chrom, x.pos,
+        str(x.ref), str(x.alt)))
+    
+    if spill_dir is not None:
+        variants = spill_run(variants, spill_dir)
+    results[key] = variants
+
+async def load_de_novos(limiter, spill_dir=None, aliases=None):
+    ''' load de novos from every study, split into ASD and non-ASD cohorts
+    
+    Loaders run concurrently, but their results are keyed by study, and
+    returned in priority order, so the order they finish in can't change the
+    merged dataset.
+    
+    Returns:
+        tuple of (asd, non_asd) lists, with an entry per study, in priority
+        order. Entries are lists of DeNovos, or paths to sorted runs if
+        spill_dir is given.
+    '''
+    results = {}
+    async with trio.open_nursery() as nursery:
+        for key, loader, uses_api in ASD_LOADERS + NON_ASD_LOADERS:
+            args = [limiter] if uses_api else []
+            nursery.start_soon(run_loader, loader, results, key, spill_dir,
+                aliases, *args)
+    
+    asd = [results[key] for key, _, _ in ASD_LOADERS]
+    non_asd = [results[key] for key, _, _ in NON_ASD_LOADERS]
+    return asd, non_asd
 
 async def get_de_novos(args):
     """ get list of all de novos in all cohorts
@@ -170,36 +396,111 @@ async def get_de_novos(args):
     header = ['person_id', 'chrom', 'pos', 'ref', 'alt', 'studies',
         'confidence', 'build', 'symbol', 'consequence']
     yield '\t'.join(header) + '\n'
-    async with RateLimiter(14) as limiter:
-        # open ASD cohort info, then drop duplicate samples from the ASD cohorts
-        asd = []
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(sanders_neuron_de_novos, asd)
-            nursery.start_soon(de_rubeis_nature_de_novos, asd)
-            nursery.start_soon(iossifov_nature_de_novos, asd)
-            nursery.start_soon(iossifov_neuron_de_novos, asd, limiter)
-            nursery.start_soon(oroak_nature_de_novos, asd, limiter)
-            nursery.start_soon(sanders_nature_de_novos, asd, limiter)
-            nursery.start_soon(an_science_de_novos, asd)
-            nursery.start_soon(yuen_nature_neuroscience_de_novos, asd)
-            nursery.start_soon(fu_nature_genetics_de_novos, asd)
+    
+    aliases = None
+    if args.aliases is not None:
+        aliases = alias_map(read_aliases(args.aliases))
+    
+    cache = args.vep_cache_db
+    annotators = open_annotators(args)
+    
+    # sorted runs are spilled to a temporary directory, which is removed
+    # however the run ends
+    spill = contextlib.nullcontext()
+    if args.external_sort is not None:
+        spill = tempfile.TemporaryDirectory(dir=args.external_sort)
+    
+    with spill as spill_dir:
+        async with open_limiter(args) as limiter:
+            asd, non_asd = await load_de_novos(limiter, spill_dir, aliases)
+            
+            if spill_dir is None:
+                # drop duplicate variants from the ASD cohorts, reversed so the
+                # highest priority study is kept. Aliased persons can span any
+                # studies, so then every cohort is merged in a single pass.
+                if aliases:
+                    cohorts = merge_duplicate_dnms(reversed(asd + non_asd),
+                        args.processes)
+                else:
+                    cohorts = merge_duplicate_dnms(reversed(asd), args.processes)
+                    cohorts = list(cohorts) + flatten(non_asd)
+                cohorts = await annotate(limiter, cohorts, args, cache,
+                    annotators, args.processes)
+                
+                for x in drop_inperson_duplicates(cohorts, args.processes):
+                    yield str(x) + '\n'
+            else:
+                # stream persons from the sorted runs, merging duplicates
+                # within the ASD cohorts, and annotate and deduplicate a chunk
+                # of persons at a time. Chunks are in person order, so the
+                # output order matches.
+                if aliases:
+                    cohorts = merge_runs(list(reversed(asd + non_asd)),
+                        merge_duplicates=True)
+                else:
+                    asd = merge_runs(list(reversed(asd)), merge_duplicates=True)
+                    non_asd = merge_runs(non_asd)
+                    cohorts = heapq.merge(asd, non_asd, key=lambda x: x.person_id)
+                for chunk in chunk_by_person(cohorts):
+                    chunk = await annotate(limiter, chunk, args, cache,
+                        annotators)
+                    for x in drop_inperson_duplicates(chunk):
+                        yield str(x) + '\n'
+
+async def get_sample_aliases(args):
+    ''' find samples which are in multiple studies under different IDs
+    '''
+    async with open_limiter(args) as limiter:
+        asd, non_asd = await load_de_novos(limiter)
+    
+    aliases = find_sample_aliases(flatten(asd + non_asd))
+    handle = io.StringIO()
+    write_aliases(aliases, handle)
+    yield handle.getvalue()
+
+async def add_study(args):
+    ''' merge a single new study into a previously built dataset
+    
+    This only merges the persons and de novos in the new study, so is much
+    quicker than rebuilding, but isn't guaranteed to match a full rebuild, as
+    variants dropped as in-person duplicates in the earlier build are gone.
+    '''
+    if not os.path.exists(args.index) and \
+            (args.existing_cohort is None or args.existing_de_novos is None):
+        raise ValueError(f'{args.index} does not exist, so --existing-cohort ' \
+            'and --existing-de-novos are needed to build it')
+    
+    header = ['person_id', 'chrom', 'pos', 'ref', 'alt', 'studies',
+        'confidence', 'build', 'symbol', 'consequence']
+    yield '\t'.join(header) + '\n'
+    
+    with MergedDataset(args.index) as dataset:
+        if len(dataset) == 0:
+            dataset.load(open_cohort(args.existing_cohort),
+                open_de_novos(args.existing_de_novos))
+        
+        de_novos = open_de_novos(args.de_novos)
+        unannotated = [x for x in de_novos if x.consequence == '']
+        if len(unannotated) > 0:
+            async with open_limiter(args) as limiter:
+                await annotate(limiter, unannotated, args, args.vep_cache_db,
+                    open_annotators(args), args.processes)
         
-        asd = merge_duplicate_dnms(reversed(asd))
-        non_asd = []
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(de_ligt_nejm_de_novos, non_asd, limiter)
-            nursery.start_soon(gilissen_nature_de_novos, non_asd, limiter)
-            nursery.start_soon(epi4k_ajhg_de_novos, non_asd, limiter)
-            nursery.start_soon(jin_nature_genetics_de_novos, non_asd)
-            nursery.start_soon(rauch_lancet_de_novos, non_asd, limiter)
-            nursery.start_soon(kaplanis_nature_de_novos, non_asd, limiter)
-            nursery.start_soon(halldorsson_science_de_novos, non_asd)
+        dataset.add_persons(open_cohort(args.cohort))
+        dataset.add_de_novos(de_novos)
         
-        cohorts = list(asd) + flatten(non_asd)
-        cohorts = await get_consequences(limiter, cohorts)
+        args.output_cohort.write('person_id\tsex\tphenotype\tstudies\n')
+        for x in dataset.iter_persons():
+            args.output_cohort.write(x + '\n')
         
-        for x in drop_inperson_duplicates(cohorts):
-            yield str(x) + '\n'
+        write_changes(dataset.changes, args.changes)
+        logging.info(f'{len(dataset.changes)} records changed')
+        
+        for x in dataset.iter_de_novos():
+            yield x + '\n'
+        
+        # only save the new study to the index once the outputs are written
+        dataset.commit()
 
 async def change_build(args):
     ''' shift variants onto a new genome build
@@ -219,8 +520,34 @@ async def _main():
     FORMAT = '%(asctime)-15s %(message)s'
     logging.basicConfig(stream=args.log, format=FORMAT, level=logging.INFO)
     
-    async for x in args.func(args):
-        _ = args.output.write(x)
+    sequence_cache = None
+    if args.sequence_cache is not None:
+        sequence_cache = SequenceCache(args.sequence_cache,
+            max_entries=args.sequence_cache_size,
+            max_bases=args.sequence_cache_bases)
+        use_sequence_cache(sequence_cache)
+    
+    if args.ensembl_url is not None:
+        set_base_url(args.ensembl_url)
+    
+    for x in args.fasta:
+        build, path = x.split('=', 1)
+        use_sequence_provider(build, IndexedFasta(path))
+    
+    # the VEP cache is opened once, and shared by every step of the run
+    args.vep_cache_db = open_vep_cache(args)
+    try:
+        async for x in args.func(args):
+            _ = args.output.write(x)
+    finally:
+        # close the caches however the run ends, so access times are saved
+        if args.vep_cache_db is not None:
+            args.vep_cache_db.close()
+        if sequence_cache is not None:
+            sequence_cache.close()
+    
+    if args.metrics is not None:
+        metrics.dump(args.metrics)
 
 def main():
     trio.run(_main)
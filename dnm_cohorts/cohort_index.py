@@ -0,0 +1,101 @@
+
+def to_bitset(indices, size):
+    ''' pack a collection of integer positions into a single python int
+
+    Setting bits one at a time on a python int copies the whole int each time,
+    so set them in a bytearray first, then convert once.
+    '''
+    data = bytearray((size + 7) // 8)
+    for i in indices:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+def from_bitset(mask):
+    ''' get the positions of the set bits in a bitset, in ascending order
+    '''
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+    for offset, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield offset * 8 + low.bit_length() - 1
+            byte ^= low
+
+class CohortIndex:
+    ''' bitset index over the phenotypes, studies and sexes in a cohort
+
+    Each person gets a fixed position in the cohort, and each phenotype, study
+    and sex is encoded as a python int with the bits set for the persons who
+    have it. Stratifying the cohort is then a matter of combining masks with
+    bitwise operators, rather than scanning the person list for each query.
+
+    Examples:
+        from dnm_cohorts import cohort
+        from dnm_cohorts.cohort_index import CohortIndex
+        index = CohortIndex(cohort)
+
+        # ASD without ID, in any study except Fu et al
+        asd = index.phenotype('HP:0000717')
+        intellectual_disability = index.phenotype('HP:0001249')
+        fu = index.study('10.1038/s41588-022-01104-0')
+        mask = asd & ~intellectual_disability & ~fu
+        index.count(mask)
+        persons = index.select(mask)
+
+    Masks are non-negative ints, so "a & ~b" works as a set difference. A mask
+    on its own can be inverted within the cohort with index.invert(mask).
+    '''
+    def __init__(self, persons):
+        self.persons = list(persons)
+        self.size = len(self.persons)
+        self.all = (1 << self.size) - 1
+
+        phenotypes, studies, sexes = {}, {}, {}
+        for i, person in enumerate(self.persons):
+            for term in person.phenotype:
+                phenotypes.setdefault(term, []).append(i)
+            for study in person.studies:
+                studies.setdefault(study, []).append(i)
+            sexes.setdefault(person.sex, []).append(i)
+
+        self.phenotypes = {k: to_bitset(v, self.size) for k, v in phenotypes.items()}
+        self.studies = {k: to_bitset(v, self.size) for k, v in studies.items()}
+        self.sexes = {k: to_bitset(v, self.size) for k, v in sexes.items()}
+
+    def __len__(self):
+        return self.size
+
+    def phenotype(self, *terms):
+        ''' get mask of persons with any of the given phenotypes
+        '''
+        return self._any(self.phenotypes, terms)
+
+    def study(self, *studies):
+        ''' get mask of persons included in any of the given studies
+        '''
+        return self._any(self.studies, studies)
+
+    def sex(self, *sexes):
+        ''' get mask of persons with any of the given sexes
+        '''
+        return self._any(self.sexes, sexes)
+
+    def _any(self, lookup, keys):
+        mask = 0
+        for key in keys:
+            mask |= lookup.get(key, 0)
+        return mask
+
+    def invert(self, mask):
+        ''' get mask of persons in the cohort who are not in the given mask
+        '''
+        return self.all & ~mask
+
+    def count(self, mask):
+        ''' count the persons in a mask
+        '''
+        return bin(mask & self.all).count('1')
+
+    def select(self, mask):
+        ''' get the persons in a mask, in cohort order
+        '''
+        return [self.persons[i] for i in from_bitset(mask & self.all)]
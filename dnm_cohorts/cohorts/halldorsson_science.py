@@ -1,11 +1,11 @@
 
-import random
 import logging
 import tempfile
 
 import pandas
 
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 from dnm_cohorts.download_file import download_file
 
 url = 'https://www.science.org/action/downloadSupplement?doi=10.1126%2Fscience.aau1043&file=aau1043_datas5_revision1.tsv'
@@ -17,8 +17,6 @@ def open_halldorsson_science_cohort():
     Halldorsson et al. Science 343: eaau1043, doi: 10.1126/science.aau1043
     """
     logging.info('getting Halldorsson et al Science 2019 cohort')
-    random.seed(1)
-    
     with tempfile.NamedTemporaryFile() as temp:
         # the url redirects, so use the requests package to open the URL
         download_file(url, temp.name)
@@ -31,9 +29,12 @@ def open_halldorsson_science_cohort():
     study = ['10.1126/science.aau1043']
     female_fraction = 0.5  # assumption from the fraction from their earlier Jonsson et al publication
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(df))
+    
     persons = set()
-    for row in df.itertuples():
-        sex = 'female' if random.random() < female_fraction else 'male'
+    for row, draw in zip(df.itertuples(), draws):
+        sex = 'female' if draw < female_fraction else 'male'
         var = Person(row.person_id, sex, phenotype, study)
         persons.add(var)
     
@@ -1,7 +1,6 @@
 
 import logging
 import os
-import random
 import tempfile
 from zipfile import ZipFile
 
@@ -9,6 +8,7 @@ import pandas
 
 from dnm_cohorts.download_file import download_file
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 
 url = 'http://science.sciencemag.org/highwire/filestream/646355/field_highwire_adjunct_files/1/aac9396_SupportingFile_Other_seq1_v4.zip'
 
@@ -19,7 +19,6 @@ def open_homsy_science_cohort():
     Homsy et al. Science 350: 1262-1266, doi: 10.1126/science.aac9396
     """
     logging.info('getting Honsy et al Science 2015 cohort')
-    random.seed(1)
     zipf = tempfile.NamedTemporaryFile()
     download_file(url, zipf.name)
     
@@ -42,10 +41,13 @@ def open_homsy_science_cohort():
     # sex isn't provided for individuals, nor the count of people per sex.
     male_fraction = 220 / (220 + 142)
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(data))
+    
     persons = set()
-    for i, row in data.iterrows():
+    for (i, row), draw in zip(data.iterrows(), draws):
         status = ['HP:0001627']
-        sex = 'male' if random.random() < male_fraction else 'female'
+        sex = 'male' if draw < male_fraction else 'female'
         if row['Developmental Delay'] == 'Yes':
             status.append('HP:0001263')
         if row['Mental Retardation'] == 'Yes':
@@ -1,11 +1,11 @@
 
 import logging
-import random
 import warnings
 
 import pandas
 
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 
 url = 'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC5675000/bin/NIHMS906719-supplement-supp_datasets.xlsx'
 
@@ -16,7 +16,6 @@ def open_jin_nature_genetics_cohort():
     Jin et al. Nature Genetics 49: 1593-1601, doi: 10.1038/ng.3970
     """
     logging.info('getting Jin et al Nature Genetics 2017 cohort')
-    random.seed(1)
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
         data = pandas.read_excel(url, 'S1', skiprows=1)
@@ -26,10 +25,13 @@ def open_jin_nature_genetics_cohort():
     male_fraction = 1691 / (1691 + 1180)
     study = ['10.1038/ng.3970']
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(data))
+    
     persons = set()
-    for i, row in data.iterrows():
+    for (i, row), draw in zip(data.iterrows(), draws):
         status = ['HP:0001627']
-        sex = 'male' if random.random() < male_fraction else 'female'
+        sex = 'male' if draw < male_fraction else 'female'
         if row['NDD'] == 'Yes':
             status.append('HP:0001263')
         
@@ -1,7 +1,6 @@
 
 import logging
 import os
-import random
 import tempfile
 import tarfile
 from zipfile import ZipFile
@@ -10,6 +9,7 @@ import pandas
 
 from dnm_cohorts.download_file import download_file
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 
 url = "https://static-content.springer.com/esm/art%3A10.1038%2Fnature24018/MediaObjects/41586_2017_BFnature24018_MOESM2_ESM.zip"
 
@@ -20,7 +20,6 @@ def open_jonsson_nature_cohort():
     Jonsson et al. Nature 549: 519-522, doi: 10.1038/nature24018
     """
     logging.info('getting Jonsson et al Nature 2017 cohort')
-    random.seed(1)
     zipf = tempfile.NamedTemporaryFile()
     download_file(url, zipf.name)
     
@@ -55,11 +54,14 @@ def open_jonsson_nature_cohort():
     phenotype = ['unaffected']
     study = ['10.1038/nature24018']
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(data))
+    
     persons = set()
-    for row in data.itertuples():
+    for row, draw in zip(data.itertuples(), draws):
         # individuals have two chances to be female, 1) if their sample if is in
         # the female group, or 2) 3.4% of the remainder are female.
-        sex = 'female' if row.person_id in females or random.random() < female_remainder else 'male'
+        sex = 'female' if row.person_id in females or draw < female_remainder else 'male'
         person = Person(row.person_id, sex, phenotype, study)
         persons.add(person)
     
@@ -1,29 +1,30 @@
 
 import logging
-import random
 
 import pandas
 
 from dnm_cohorts.person import Person
 from dnm_cohorts.mock_probands import add_mock_probands
+from dnm_cohorts.random_id import cohort_rng
 
 url = 'https://static-content.springer.com/esm/art%3A10.1038%2Fs41586-020-2832-5/MediaObjects/41586_2020_2832_MOESM3_ESM.txt'
 
-def subcohort(rows, counts, prefix, suffix, study):
+def subcohort(rows, counts, prefix, suffix, study, rng):
     '''
     '''
     phenotype = ['HP:0001249']
     total = sum(counts.values())
     male_fraction = counts['male'] / total
     
+    is_male = rng.random(len(rows)) < male_fraction
     persons = set()
-    for i, row in rows.iterrows():
-        sex = 'male' if random.random() < male_fraction else 'female'
-        person = Person(row['person_id'], sex, phenotype, study)
+    for person_id, male in zip(rows['person_id'], is_male):
+        sex = 'male' if male else 'female'
+        person = Person(person_id, sex, phenotype, study)
         persons.add(person)
     
     # account for individuals without exomic de novo mutations
-    return add_mock_probands(persons, total, prefix, suffix, phenotype, study)
+    return add_mock_probands(persons, total, prefix, suffix, phenotype, study, rng)
 
 def kaplanis_nature_cohort():
     """ get proband details for Kaplanis et al Nature 2019
@@ -32,7 +33,6 @@ def kaplanis_nature_cohort():
     doi: 10.1038/s41586-020-2832-5
     """
     logging.info('getting Kaplanis et al Nature 2019 cohort')
-    random.seed(1)
     data = pandas.read_table(url)
     
     # define male and female numbers for each of the subcohorts (DDD, geneDx and
@@ -48,9 +48,11 @@ def kaplanis_nature_cohort():
     phenotype = ['HP:0001249']
     doi = ['10.1038/s41586-020-2832-5']
     
+    # give each subcohort its own generator, so they don't depend on each other
     persons = set()
     for study in counts:
         rows = data[data['study'] == study]
-        persons |= subcohort(rows, counts[study], study.lower(), study, doi)
+        rng = cohort_rng(f'{doi[0]}|{study}')
+        persons |= subcohort(rows, counts[study], study.lower(), study, doi, rng)
     
     return persons
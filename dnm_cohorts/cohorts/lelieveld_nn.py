@@ -1,10 +1,10 @@
 
 import logging
-import random
 
 import pandas
 
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 
 url = 'https://static-content.springer.com/esm/art%3A10.1038%2Fnn.4352/MediaObjects/41593_2016_BFnn4352_MOESM21_ESM.xlsx'
 
@@ -16,7 +16,6 @@ def open_lelieveld_cohort():
     Supplementary table S2.
     """
     logging.info('getting Lelieveld et al Nature Neuroscience 2016 cohort')
-    random.seed(1)
     data = pandas.read_excel(url, sheet_name='Supplementary Table 2')
     
     phenotype = ['HP:0001249']
@@ -26,9 +25,12 @@ def open_lelieveld_cohort():
     ids = [ str(x) + '|lelieveld' for x in ids ]
     male_fraction = 461 / (461 + 359)
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(ids))
+    
     persons = set()
-    for person_id in ids:
-        sex = 'male' if random.random() < male_fraction else 'female'
+    for person_id, draw in zip(ids, draws):
+        sex = 'male' if draw < male_fraction else 'female'
         person = Person(person_id, sex, phenotype, study)
         persons.add(person)
     
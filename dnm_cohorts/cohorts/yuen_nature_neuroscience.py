@@ -1,9 +1,9 @@
 import logging
-import random
 
 import pandas
 
 from dnm_cohorts.person import Person
+from dnm_cohorts.random_id import cohort_rng
 
 url = 'https://static-content.springer.com/esm/art%3A10.1038%2Fnn.4524/MediaObjects/41593_2017_BFnn4524_MOESM53_ESM.xlsx'
 dnms_url = 'https://static-content.springer.com/esm/art%3A10.1038%2Fnn.4524/MediaObjects/41593_2017_BFnn4524_MOESM49_ESM.xlsx'
@@ -16,7 +16,6 @@ def open_yuen_nature_genetics_cohort():
     doi: 10.1038/nn.4524
     """
     logging.info(f'getting Yuen et al Nature Neuroscience 2017 cohort')
-    random.seed(1)
     data = pandas.read_excel(url, 'Table S7', skiprows=1)
     data['person_id'] = data['SUBMITTED_ID'].astype(str) + '|asd_cohorts'
     
@@ -31,9 +30,12 @@ def open_yuen_nature_genetics_cohort():
     
     male_fraction = 2062 / (2062 + 558)
     
+    rng = cohort_rng(study[0])
+    draws = rng.random(len(data))
+    
     persons = set()
-    for row in data.itertuples():
-        sex = 'male' if random.random() < male_fraction else 'female'
+    for row, draw in zip(data.itertuples(), draws):
+        sex = 'male' if draw < male_fraction else 'female'
         person = Person(row.person_id, sex, phenotype, study)
         persons.add(person)
     
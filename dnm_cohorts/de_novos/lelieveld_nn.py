@@ -4,7 +4,7 @@ import logging
 
 import pandas
 
-from dnm_cohorts.ensembl import parallel_sequence
+from dnm_cohorts.ensembl import parallel_sequence, prefetch_sequences
 from dnm_cohorts.de_novo import DeNovo
 
 url = "https://static-content.springer.com/esm/art%3A10.1038%2Fnn.4352/MediaObjects/41593_2016_BFnn4352_MOESM21_ESM.xlsx"
@@ -21,6 +21,11 @@ async def fix_alleles(limiter, data):
     
     idx = ref.isnull()
     
+    # fetch sequence for insertions and deletions together, in a few requests
+    await prefetch_sequences(limiter,
+        [(x.chrom, x.pos, x.pos, x.build) for i, x in data[idx].iterrows()] +
+        [(x.chrom, x.pos - 1, x.pos - 1, x.build) for i, x in data[alt.isnull()].iterrows()])
+    
     seqs = {}
     coords = [(x.chrom, x.pos, x.pos, x.build) for i, x in data[idx].iterrows()]
     async with trio.open_nursery() as nursery:
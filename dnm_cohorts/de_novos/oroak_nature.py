@@ -4,7 +4,7 @@ import logging
 
 import pandas
 
-from dnm_cohorts.ensembl import parallel_sequence
+from dnm_cohorts.ensembl import parallel_sequence, prefetch_sequences
 from dnm_cohorts.fix_alleles import fix_het_alleles
 from dnm_cohorts.de_novo import DeNovo
 
@@ -36,6 +36,7 @@ async def fix_alleles(limiter, data):
     seqs = {}
     dels_coords = [(x.chrom, x.pos, x.pos, x.build) for i, x in data[dels].iterrows()]
     ins_coords = [(x.chrom, x.pos, x.pos, x.build) for i, x in data[ins].iterrows()]
+    await prefetch_sequences(limiter, dels_coords + ins_coords)
     async with trio.open_nursery() as nursery:
         for x in dels_coords + ins_coords:
             nursery.start_soon(parallel_sequence, limiter, *x[:3], seqs, x[3])
@@ -4,7 +4,7 @@ import logging
 
 import pandas
 
-from dnm_cohorts.ensembl import parallel_sequence
+from dnm_cohorts.ensembl import parallel_sequence, prefetch_sequences
 from dnm_cohorts.fix_alleles import fix_het_alleles
 from dnm_cohorts.de_novo import DeNovo
 
@@ -20,6 +20,7 @@ async def fix_alleles(limiter, data):
     seqs = {}
     alts_coords = [(x.chrom, x.pos, x.pos, x.build) for i, x in data[idx].iterrows()]
     refs_coords = [(x.chrom, x.pos, x.pos + len(x.alt.split(':')[1]), x.build) for i, x in data[idx].iterrows()]
+    await prefetch_sequences(limiter, alts_coords + refs_coords)
     async with trio.open_nursery() as nursery:
         for x in alts_coords + refs_coords:
             nursery.start_soon(parallel_sequence, limiter, *x[:3], seqs, x[3])
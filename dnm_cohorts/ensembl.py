@@ -2,7 +2,12 @@
 
 import logging
 import json
+from collections import deque
+
 import trio
+from asks.errors import BadStatus
+
+from dnm_cohorts.sequence_cache import SequenceCache
 
 # consequence list, as sorted at
 # https://www.ensembl.org/info/genome/variation/prediction/predicted_data.html
@@ -49,8 +54,75 @@ consequences = [
     ]
 severity = dict(zip(consequences, range(len(consequences))))
 
+# SequenceCache for genome_sequence, see use_sequence_cache(). This defaults to
+# an in-memory cache, which holds windows from prefetch_sequences for this run,
+# and is only opened on first use, so importing this module doesn't open it
+DEFAULT_CACHE = object()
+sequence_cache = DEFAULT_CACHE
+
+def use_sequence_cache(cache):
+    ''' answer genome_sequence requests from a SequenceCache where possible
+    
+    Args:
+        cache: SequenceCache object, or None to stop using a cache
+    '''
+    global sequence_cache
+    sequence_cache = cache
+
+def get_sequence_cache():
+    ''' get the SequenceCache in use, opening the default cache if needed
+    
+    Returns:
+        SequenceCache object, or None if not using a cache
+    '''
+    global sequence_cache
+    if sequence_cache is DEFAULT_CACHE:
+        sequence_cache = SequenceCache(':memory:')
+    return sequence_cache
+
+# local sequence providers (e.g. IndexedFasta) for each genome build, which
+# genome_sequence checks before the cache and the REST API
+sequence_providers = {}
+
+def use_sequence_provider(build, provider):
+    ''' answer genome_sequence requests for a genome build from a local provider
+    
+    Args:
+        build: genome build e.g. 'grch37'
+        provider: object supporting `chrom in provider` and
+            provider.sequence(chrom, start, end), or None to stop using a
+            provider for the build. Chromosomes missing from the provider fall
+            back to Ensembl.
+    '''
+    if provider is None:
+        sequence_providers.pop(build, None)
+    else:
+        sequence_providers[build] = provider
+
+def local_sequence(chrom, start, end, build):
+    ''' get sequence from a local provider, or None if no provider covers it
+    '''
+    provider = sequence_providers.get(build)
+    if provider is None or chrom not in provider:
+        return None
+    return provider.sequence(chrom, start, end)
+
+# REST server to use instead of Ensembl for every build, see set_base_url()
+base_url = None
+
+def set_base_url(url):
+    ''' send REST requests to another server, e.g. a local mock server
+    
+    Args:
+        url: base URL e.g. 'http://localhost:8000', or None to use Ensembl
+    '''
+    global base_url
+    base_url = None if url is None else url.rstrip('/')
+
 def get_base_url(build):
     assert build in ["grch37", "grch38"], f'unknown build: {build}'
+    if base_url is not None:
+        return base_url
     ver = build + '.' if build == "grch37" else ''
     return f'https://{ver}rest.ensembl.org'
 
@@ -126,13 +198,180 @@ def most_severe(data, exclude_bad=True):
     tx = min(transcripts, key=lambda x: (severity[x['cq']], x['not_hgnc']))
     return tx['cq'], tx['gene_symbol']
 
-async def get_consequences(limiter, variants):
+async def cq_and_symbol_batch(limiter, variants, sem):
+    """ find VEP consequences for a batch of variants, via a single POST
+    
+    Variants are sent in VCF format, with their index in the batch as the
+    variant ID, so the results can be matched back to the variants.
+    
+    Args:
+        limiter: object for asynchronously calling ensembl REST API
+        variants: list of variants, all on the same genome build, and with
+            non-empty ref and alt alleles.
+        sem: CapacityLimiter for the number of simultaneous requests
+    
+    Returns:
+        list of variants missing from the results, e.g. if VEP couldn't parse
+        them.
+    """
+    lines = [f'{x.chrom} {x.pos} var{i} {x.ref} {x.alt} . . .' for i, x in enumerate(variants)]
+    url = f'{get_base_url(variants[0].build)}/vep/human/region'
+    headers = {'content-type': 'application/json', 'accept': 'application/json'}
+    async with sem:
+        resp = await limiter.post(url, data=json.dumps({'variants': lines}),
+            headers=headers)
+    data = {x['id']: x for x in json.loads(resp)}
+    
+    missing = []
+    for i, var in enumerate(variants):
+        key = f'var{i}'
+        if key in data:
+            var.consequence, var.symbol = most_severe(data[key])
+        else:
+            missing.append(var)
+    return missing
+
+async def annotate_batch(limiter, variants, sem):
+    """ annotate a batch of variants, splitting the batch if VEP rejects it
+    
+    Batches which VEP rejects with a 4xx response are split in half, without
+    retrying, so a single problem variant only ends up on the per-variant
+    endpoint. Other errors (e.g. server errors, or an open circuit breaker)
+    are raised. Variants missing from batch results are annotated individually.
+    
+    Returns:
+        list of (function, argument) jobs for the halves of a split batch, or
+        an empty list if the batch was annotated.
+    """
+    if len(variants) == 1:
+        await cq_and_symbol(limiter, variants[0], sem)
+        return []
+    
+    try:
+        missing = await cq_and_symbol_batch(limiter, variants, sem)
+    except BadStatus as err:
+        if not 400 <= err.status_code < 500 or err.status_code == 429:
+            raise
+        logging.warning(f'splitting VEP batch of {len(variants)} variants: {err}')
+        mid = len(variants) // 2
+        return [(annotate_batch, variants[:mid]), (annotate_batch, variants[mid:])]
+    
+    for var in missing:
+        await cq_and_symbol(limiter, var, sem)
+    return []
+
+# Ensembl release for each server, so this is only requested once per run
+known_releases = {}
+
+async def ensembl_release(limiter, build):
+    ''' find the current Ensembl release for a genome build
+    '''
+    url = f'{get_base_url(build)}/info/data'
+    if url not in known_releases:
+        resp = await limiter.get(url)
+        known_releases[url] = max(json.loads(resp)['releases'])
+    return known_releases[url]
+
+def annotation_jobs(variants, batch_size=None):
+    ''' split variants into annotation jobs, without building every job upfront
+    
+    Yields:
+        tuples of (function, argument) for each job, where the argument is a
+        single variant for cq_and_symbol, or a list of variants for
+        annotate_batch.
+    '''
+    if not batch_size:
+        for x in variants:
+            yield cq_and_symbol, x
+        return
+    
+    # VCF format can't represent empty alleles, so annotate those individually
+    batches = {}
+    singles = []
+    for x in variants:
+        if x.ref and x.alt:
+            batches.setdefault(x.build, []).append(x)
+        else:
+            singles.append(x)
+    
+    for group in batches.values():
+        for i in range(0, len(group), batch_size):
+            yield annotate_batch, group[i:i + batch_size]
+    for x in singles:
+        yield cq_and_symbol, x
+
+async def get_consequences(limiter, variants, batch_size=None, cache=None,
+        workers=50, done=None):
     ''' asychronously get variant consequences and symbols from ensembl
+    
+    Variants are annotated by a fixed pool of workers, fed through a bounded
+    channel, so the number of tasks stays constant however many variants
+    there are. Halves of batches which VEP rejects run on the same workers.
+    
+    Args:
+        limiter: object for asynchronously calling ensembl REST API
+        variants: list of variants to annotate
+        batch_size: number of variants to send per POST request (the Ensembl
+            maximum is 200). If None, annotate each variant with a GET request.
+        cache: VepCache, so only variants without current cached annotations
+            are sent to Ensembl.
+        workers: number of simultaneous annotation jobs
+        done: optional trio send channel, which annotated variants are sent to
+            as they complete. This is closed once every variant is annotated.
     '''
-    sem = trio.CapacityLimiter(50)
+    if workers < 1:
+        raise ValueError(f'need at least one worker, not {workers}')
+    
+    if cache is not None:
+        releases = {}
+        for build in set(x.build for x in variants):
+            releases[build] = await ensembl_release(limiter, build)
+        missing = cache.lookup(variants, releases)
+        logging.info(f'{len(variants) - len(missing)} of {len(variants)} ' \
+            'variants annotated from the VEP cache')
+        if done is not None:
+            ids = set(id(x) for x in missing)
+            for x in variants:
+                if id(x) not in ids:
+                    await done.send(x)
+        await get_consequences(limiter, missing, batch_size, workers=workers,
+            done=done)
+        cache.store(missing, releases)
+        return variants
+    
+    sem = trio.CapacityLimiter(workers)
+    send, receive = trio.open_memory_channel(workers)
+    # halves of split batches, which workers take before any new jobs
+    splits = deque()
+    
+    async def produce():
+        async with send:
+            for job in annotation_jobs(variants, batch_size):
+                await send.send(job)
+    
+    async def run(func, arg):
+        jobs = await func(limiter, arg, sem)
+        if jobs:
+            splits.extend(jobs)
+        elif done is not None:
+            for x in (arg if isinstance(arg, list) else [arg]):
+                await done.send(x)
+    
+    async def work(receive):
+        async with receive:
+            async for func, arg in receive:
+                await run(func, arg)
+                while splits:
+                    await run(*splits.popleft())
+    
     async with trio.open_nursery() as nursery:
-        for x in variants:
-            nursery.start_soon(cq_and_symbol, limiter, x, sem)
+        nursery.start_soon(produce)
+        async with receive:
+            for _ in range(workers):
+                nursery.start_soon(work, receive.clone())
+    
+    if done is not None:
+        await done.aclose()
     return variants
 
 async def genome_sequence(ensembl, chrom, start, end, build='grch37'):
@@ -146,6 +385,9 @@ async def genome_sequence(ensembl, chrom, start, end, build='grch37'):
         build: genome build to find consequences on
         verbose: flag indicating whether to print variants as they are checked
     
+    Sequence comes from a local provider for the build if one is set (see
+    use_sequence_provider), then the sequence cache, then the REST API.
+    
     Returns:
         DNA sequence for genome region as str
     
@@ -156,12 +398,24 @@ async def genome_sequence(ensembl, chrom, start, end, build='grch37'):
     if end < start:
         end = start
     
+    seq = local_sequence(chrom, start, end, build)
+    if seq is not None:
+        return seq
+    
+    cache = get_sequence_cache()
+    if cache is not None:
+        seq = cache.get(build, chrom, start, end)
+        if seq is not None:
+            return seq
+    
     ext = f"sequence/region/human/{chrom}:{start}:{end}:1"
     url = f'{get_base_url(build)}/{ext}'
     resp = await ensembl.get(url)
     data = json.loads(resp)
     
     if len(data) > 0:
+        if cache is not None:
+            cache.store(build, chrom, start, end, data['seq'])
         return data['seq']
     
     return ""
@@ -170,3 +424,89 @@ async def parallel_sequence(ensembl, chrom, start, end, seqs, build='grch37'):
     ''' this enables parallelisation by storing genome seq in a dict passed in
     '''
     seqs[(chrom, start, end, build)] = await genome_sequence(ensembl, chrom, start, end, build)
+
+def plan_regions(regions, max_gap=1000, max_length=100000):
+    """ merge nearby sequence requests into a few larger windows
+    
+    Args:
+        regions: iterable of (chrom, start, end, build) tuples
+        max_gap: merge regions separated by up to this many bases
+        max_length: maximum length of a merged window
+    
+    Returns:
+        list of (chrom, start, end, build) windows, which cover every region
+    """
+    regions = set((str(c), s, max(s, e), b) for c, s, e, b in regions)
+    windows = []
+    for chrom, start, end, build in sorted(regions, key=lambda x: (x[3], x[0], x[1])):
+        if windows:
+            w_chrom, w_start, w_end, w_build = windows[-1]
+            if (w_chrom, w_build) == (chrom, build) and start <= w_end + max_gap \
+                    and max(end, w_end) - w_start < max_length:
+                windows[-1] = (chrom, w_start, max(end, w_end), build)
+                continue
+        windows.append((chrom, start, end, build))
+    return windows
+
+async def sequence_batch(ensembl, windows, sem):
+    """ fetch sequence for a batch of windows via a single POST, and cache them
+    
+    Args:
+        ensembl: object for asynchronously calling ensembl REST API
+        windows: list of (chrom, start, end, build) tuples, all on one build
+        sem: CapacityLimiter for the number of simultaneous requests
+    """
+    build = windows[0][3]
+    queries = {f'{c}:{s}..{e}:1': (c, s, e) for c, s, e, _ in windows}
+    url = f'{get_base_url(build)}/sequence/region/human'
+    headers = {'content-type': 'application/json', 'accept': 'application/json'}
+    try:
+        async with sem:
+            resp = await ensembl.post(url, data=json.dumps({'regions': list(queries)}),
+                headers=headers)
+    except Exception as err:
+        # windows which fail here are requested individually by genome_sequence
+        logging.warning(f'could not prefetch {len(windows)} sequence windows: {err}')
+        return
+    
+    cache = get_sequence_cache()
+    for x in json.loads(resp):
+        if x.get('query') in queries and 'seq' in x:
+            cache.store(build, *queries[x['query']], x['seq'])
+
+async def prefetch_sequences(ensembl, regions, max_gap=1000, max_length=100000,
+        batch_size=50):
+    """ fetch sequence for many regions in a few requests, ahead of genome_sequence
+    
+    Loaders often need sequence at many sites close to each other, e.g. at a
+    variant and the base before it. Rather than a request per region, nearby
+    regions are merged into larger windows, and windows are requested in
+    batches (the Ensembl maximum is 50 regions per POST). The windows are put
+    in the sequence cache, so later genome_sequence calls for any of the
+    regions are sliced from the cached windows.
+    
+    Args:
+        ensembl: object for asynchronously calling ensembl REST API
+        regions: iterable of (chrom, start, end, build) tuples, as they will be
+            passed to genome_sequence.
+        max_gap: merge regions separated by up to this many bases
+        max_length: maximum length of a merged window
+        batch_size: number of windows per POST request
+    """
+    cache = get_sequence_cache()
+    if cache is None:
+        return
+    
+    # skip regions which a local sequence provider can answer
+    regions = [x for x in regions if x[0] not in sequence_providers.get(x[3], ())]
+    
+    windows = {}
+    for x in plan_regions(regions, max_gap, max_length):
+        if cache.get(x[3], *x[:3]) is None:
+            windows.setdefault(x[3], []).append(x)
+    
+    sem = trio.CapacityLimiter(50)
+    async with trio.open_nursery() as nursery:
+        for group in windows.values():
+            for i in range(0, len(group), batch_size):
+                nursery.start_soon(sequence_batch, ensembl, group[i:i + batch_size], sem)
@@ -1,29 +1,198 @@
 
-from itertools import groupby
+import heapq
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby
 
-from dnm_cohorts.ensembl import severity
+import numpy
+import pandas
 
-def drop_inperson_duplicates(de_novos):
+from dnm_cohorts.ensembl import consequences
+
+def canonical_interval(var):
+    ''' get the range of a variant, standardised to the grch38 genome build
+    
+    Variants which can't be lifted over keep their original coordinates, but
+    are keyed by their own build, so they only match variants on that build.
+    
+    Returns:
+        tuple of ((build, chrom), start, end)
+    '''
+    lifted = var
+    if var.build != 'grch38':
+        try:
+            lifted = var.to_build('grch38') or var
+        except Exception:
+            pass
+    start, end = lifted.range
+    return (lifted.build, lifted.chrom), start, end
+
+class VariantIntervals:
+    ''' sorted interval index of the variants kept for a single person
+    
+    Intervals are held per chromosome in a list sorted by start position, so
+    variants overlapping a new variant are found by bisection, rather than by
+    comparing against every variant already kept.
+    '''
+    def __init__(self):
+        self.intervals = {}
+        self.max_span = {}
+    
+    def add(self, key, start, end, var):
+        if key not in self.intervals:
+            self.intervals[key] = []
+            self.max_span[key] = 0
+        # include id() so ties on position never fall back to comparing variants
+        insort(self.intervals[key], (start, end, id(var), var))
+        self.max_span[key] = max(self.max_span[key], end - start)
+    
+    def pop_overlapping(self, key, start, end):
+        ''' remove and return variants overlapping a range, in position order
+        '''
+        if key not in self.intervals:
+            return []
+        intervals = self.intervals[key]
+        # any overlapping interval must start within max_span of the range
+        lo = bisect_left(intervals, (start - self.max_span[key], ))
+        hi = bisect_right(intervals, (end, float('inf')))
+        matched = [i for i in range(lo, hi) if intervals[i][1] >= start]
+        overlapping = [intervals[i][3] for i in matched]
+        for i in reversed(matched):
+            del intervals[i]
+        return overlapping
+    
+    def variants(self):
+        return [x[3] for key in self.intervals for x in self.intervals[key]]
+
+def merge_person_dnms(group):
+    ''' merge duplicate de novos within the variants for one person
+    
+    Check if any variants already included overlap the same range (we can't
+    just check for exact positions). When a variant overlaps ones already
+    included, it replaces them, and takes on the studies from all of them.
+    
+    Args:
+        group: iterable of DeNovo objects for a single person
+    
+    Returns:
+        list of unique DeNovo objects
+    '''
+    index = VariantIntervals()
+    for var in group:
+        key, start, end = canonical_interval(var)
+        overlapping = index.pop_overlapping(key, start, end)
+        if overlapping:
+            studies = [var.study]
+            for x in overlapping:
+                studies += x.study.split(',')
+            var.study = ','.join(sorted(set(studies)))
+        index.add(key, start, end, var)
+    return index.variants()
+
+def partition_by_person(de_novos, partitions):
+    ''' hash-partition variants by person ID
+    
+    All the variants for a person end up in the same partition, in their input
+    order. This uses crc32 rather than hash(), since python salts string hashes
+    per process, and partitions should be the same between runs.
+    '''
+    parts = [[] for _ in range(partitions)]
+    for x in de_novos:
+        parts[zlib.crc32(x.person_id.encode('utf8')) % partitions].append(x)
+    return parts
+
+def in_parallel(func, de_novos, processes, key):
+    ''' run a per-person merge function over partitions in worker processes
+    
+    Args:
+        func: function which takes a list of DeNovos, and returns a list sorted
+            by a key which starts with the person ID
+        de_novos: iterable of DeNovo objects
+        processes: number of worker processes
+        key: sort key for the function output, used to reassemble the results
+            in the same order as running func on the whole dataset
+    
+    Returns:
+        list of DeNovo objects
+    '''
+    parts = partition_by_person(de_novos, processes)
+    with ProcessPoolExecutor(processes) as pool:
+        results = list(pool.map(func, parts))
+    return list(heapq.merge(*results, key=key))
+
+def merge_duplicate_dnms(cohorts, processes=1):
+    """ only include unique variants
+    
+    Args:
+        cohorts: list of lists of DeNovo objects, one per study. Where variants
+            are duplicated, the variant from the later study is kept.
+        processes: number of processes to use. Variants are partitioned by
+            person ID between processes, since persons are merged independently.
+    
+    Returns:
+        list of unique DeNovo objects, grouped by person
+    """
+    de_novos = chain.from_iterable(cohorts)
+    if processes > 1:
+        return in_parallel(_merge_partition, de_novos, processes,
+            key=lambda x: x.person_id)
+    
+    de_novos = sorted(de_novos, key=lambda x: x.person_id)
+    unique = []
+    for _id, group in groupby(de_novos, key=lambda x: x.person_id):
+        unique += merge_person_dnms(group)
+    
+    return unique
+
+def _merge_partition(de_novos):
+    return merge_duplicate_dnms([de_novos])
+
+def drop_inperson_duplicates(de_novos, processes=1):
     """ get independent mutation events per person
     
     Occasionally an individual will have multiple de novo mutations within a
     gene. We only want to count the mutated gene once per individual, while
     preferring to count the most damaging mutations.
     
+    This works on columns of person IDs, symbols and consequences rather than
+    on the variant objects. Consequences are ranked with integer severity
+    codes, then a stable sort by (person, symbol, severity) puts the most
+    severe variant (earliest in the input, for ties) first within each person
+    and gene, so we only need to drop the later rows for each gene. Variants
+    without a symbol are all kept.
+    
     Args:
-        list of DeNovo objects
+        de_novos: list of DeNovo objects
+        processes: number of processes to use, with variants partitioned by
+            person ID between processes.
+    
+    Returns:
+        list of DeNovo objects, sorted by person ID and symbol
     """
-    # make sure the dataset is sorted by person ID and symbol, so we can group
-    # consecutive variants in the same person and gene
-    de_novos = sorted(de_novos, key=lambda x: (x.person_id, x.symbol))
-    
-    included = []
-    for (_, symbol), group in groupby(de_novos, key=lambda x: (x.person_id, x.symbol)):
-        group = list(group)
-        if symbol != '' and symbol is not None:
-            cq = min(( x.consequence for x in group ), key=lambda x: severity[x])
-            group = [ x for x in group if x.consequence == cq ]
-            group = group[:1]
-        included += group
-    
-    return included
+    if processes > 1:
+        return in_parallel(drop_inperson_duplicates, de_novos, processes,
+            key=lambda x: (x.person_id, x.symbol))
+    
+    de_novos = list(de_novos)
+    if len(de_novos) == 0:
+        return []
+    
+    table = pandas.DataFrame({
+        'person_id': [x.person_id for x in de_novos],
+        'symbol': [x.symbol for x in de_novos],
+        'consequence': [x.consequence for x in de_novos],
+        })
+    
+    has_symbol = (table['symbol'] != '') & table['symbol'].notnull()
+    codes = pandas.Categorical(table['consequence'], categories=consequences).codes
+    unknown = has_symbol & (codes == -1)
+    if unknown.any():
+        raise KeyError(table['consequence'][unknown].iloc[0])
+    
+    # leave variants without symbols at equal severity, so they keep their order
+    table['severity'] = numpy.where(has_symbol, codes, 0)
+    table = table.sort_values(['person_id', 'symbol', 'severity'], kind='stable')
+    
+    duplicated = table.duplicated(['person_id', 'symbol']) & has_symbol[table.index]
+    return [de_novos[i] for i in table.index[~duplicated]]
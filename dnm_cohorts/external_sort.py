@@ -0,0 +1,73 @@
+# functions to merge de novos from sorted runs on disk, for datasets which are
+# too large to hold every variant in memory at once
+
+import gzip
+import heapq
+import tempfile
+from itertools import groupby
+
+from dnm_cohorts.de_novo import DeNovo
+from dnm_cohorts.exclude_duplicates import merge_person_dnms
+
+def spill_run(de_novos, directory):
+    ''' write variants to disk as a run sorted by person ID
+    
+    Args:
+        de_novos: iterable of DeNovo objects
+        directory: folder to write the run into
+    
+    Returns:
+        path to the sorted run
+    '''
+    de_novos = sorted(de_novos, key=lambda x: x.person_id)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.txt.gz', delete=False) as temp:
+        with gzip.open(temp, 'wt', compresslevel=1) as handle:
+            for x in de_novos:
+                handle.write(str(x) + '\n')
+    return temp.name
+
+def read_run(path):
+    ''' stream variants back from a sorted run
+    '''
+    with gzip.open(path, 'rt') as handle:
+        for line in handle:
+            yield DeNovo(*line.strip('\n').split('\t'))
+
+def merge_runs(paths, merge_duplicates=False):
+    ''' k-way merge of sorted runs, streaming variants in person ID order
+    
+    heapq.merge is stable, so variants for the same person come out in the
+    order of the runs, which matches sorting the concatenated runs in memory.
+    
+    Args:
+        paths: list of paths to runs, see spill_run()
+        merge_duplicates: whether to merge duplicate variants within each person
+            (with the variant from the later run kept), as merge_duplicate_dnms
+    '''
+    runs = [read_run(x) for x in paths]
+    merged = heapq.merge(*runs, key=lambda x: x.person_id)
+    if not merge_duplicates:
+        yield from merged
+        return
+    
+    for _id, group in groupby(merged, key=lambda x: x.person_id):
+        yield from merge_person_dnms(group)
+
+def chunk_by_person(de_novos, size=50000):
+    ''' group a person-sorted stream of variants into chunks of whole persons
+    
+    Per-person steps (e.g. dropping duplicates within genes) can then run on
+    each chunk independently.
+    
+    Args:
+        de_novos: iterable of DeNovo objects, sorted by person ID
+        size: minimum number of variants per chunk (except for the last)
+    '''
+    chunk = []
+    for _id, group in groupby(de_novos, key=lambda x: x.person_id):
+        chunk += group
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,94 @@
+# local reference genome sequence, from an indexed FASTA file, so allele fixing
+# doesn't need the Ensembl REST API
+
+import mmap
+import os
+
+class IndexedFasta:
+    ''' sequence provider reading from a FASTA file with a samtools .fai index
+    
+    The FASTA is memory-mapped, so only the pages holding requested regions are
+    read from disk. The FASTA must be uncompressed (not bgzipped). Sequence is
+    returned in uppercase, to match the Ensembl sequence endpoint.
+    
+    Sequence providers define `chrom in provider` and
+    provider.sequence(chrom, start, end), see ensembl.use_sequence_provider().
+    '''
+    def __init__(self, path, index=None):
+        ''' initialize the class object
+        
+        Args:
+            path: path to uncompressed FASTA file
+            index: path to .fai index. Defaults to path + '.fai'
+        '''
+        self.path = path
+        index = path + '.fai' if index is None else index
+        if not os.path.exists(index):
+            raise ValueError(f'no FASTA index at {index}, try "samtools faidx {path}"')
+        
+        self.index = {}
+        with open(index, 'rt') as handle:
+            for line in handle:
+                name, length, offset, linebases, linewidth = line.split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(linebases),
+                    int(linewidth))
+        
+        self.handle = open(path, 'rb')
+        self.mm = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def __getstate__(self):
+        # memory maps can't be pickled, so worker processes reopen the file
+        state = self.__dict__.copy()
+        del state['handle'], state['mm']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handle = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *err):
+        self.close()
+    
+    def close(self):
+        self.mm.close()
+        self.handle.close()
+    
+    def _name(self, chrom):
+        ''' match chromosome names with or without a 'chr' prefix
+        '''
+        chrom = str(chrom)
+        alts = [chrom, 'chr' + chrom, chrom.replace('chr', '')]
+        if chrom in ['MT', 'chrM']:
+            alts += ['chrM', 'MT']
+        for name in alts:
+            if name in self.index:
+                return name
+        return None
+    
+    def __contains__(self, chrom):
+        return self._name(chrom) is not None
+    
+    def sequence(self, chrom, start, end):
+        ''' get sequence for a region (1-based, inclusive coordinates)
+        
+        Returns:
+            DNA sequence as str, or None if the chromosome isn't in the FASTA
+        '''
+        name = self._name(chrom)
+        if name is None:
+            return None
+        length, offset, linebases, linewidth = self.index[name]
+        start, end = max(start, 1), min(end, length)
+        if end < start:
+            return ''
+        
+        def locate(pos):
+            # find the file offset of a 0-based position on the chromosome
+            return offset + (pos // linebases) * linewidth + pos % linebases
+        
+        raw = self.mm[locate(start - 1):locate(end - 1) + 1]
+        return raw.replace(b'\n', b'').replace(b'\r', b'').decode('ascii').upper()
@@ -26,6 +26,21 @@ async def fix_substitution(chrom, start, end, alleles):
     sep = re.compile('-[&gt;|>]*')
     return sep.split(alleles)
 
+def allele_regions(chrom, start, end, allele, build='grch37'):
+    """ find the regions fix_deletion or fix_insertion need sequence for
+    
+    Returns:
+        list of (chrom, start, end, build) tuples, for prefetch_sequences
+    """
+    if 'sub' in allele:
+        return []
+    elif 'del' in allele:
+        distance = int(re.sub('\(|\)|del', '', allele))
+        return [(chrom, start, end, build), (chrom, start, end + distance, build)]
+    elif 'ins' in allele:
+        return [(chrom, start - 1, end - 1, build)]
+    return []
+
 async def fix_deletion(limiter, chrom, start, end, allele):
     """ fix deletion allele codes
     
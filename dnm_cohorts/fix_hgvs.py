@@ -3,8 +3,9 @@ import re
 
 from hgvs.parser import Parser
 
-from dnm_cohorts.ensembl import genome_sequence
-from dnm_cohorts.fix_alleles import fix_substitution, fix_deletion, fix_insertion
+from dnm_cohorts.ensembl import genome_sequence, prefetch_sequences
+from dnm_cohorts.fix_alleles import (fix_substitution, fix_deletion,
+    fix_insertion, allele_regions)
 
 hgvs_parser = Parser()
 
@@ -22,9 +23,24 @@ async def fix_hgvs_coordinates(limiter, coords):
     fix_hgvs_coordinates(['chr7:g.155556643G>A',
         'chr3:g.11060365_11060365del', 'chr13:g.50057690_50057691insA'])
     """
+    variants = [hgvs_parser.parse_hgvs_variant(x) for x in coords]
+    
+    # find every region we need sequence for, so they can be prefetched in a
+    # few requests, rather than one request per variant
+    regions = []
+    for var in variants:
+        chrom = var.ac.replace('chr', '')
+        pos = var.posedit.pos.start.base
+        end = var.posedit.pos.end.base
+        type = var.posedit.edit.type
+        if type in ['del', 'dup']:
+            regions.append((chrom, pos, end + 1, 'grch37'))
+        elif type in ['delins', 'ins']:
+            regions.append((chrom, pos, end, 'grch37'))
+    await prefetch_sequences(limiter, regions)
+    
     chroms, positions, refs, alts = [], [], [], []
-    for coord in coords:
-        var = hgvs_parser.parse_hgvs_variant(coord)
+    for var in variants:
         chrom = var.ac.replace('chr', '')
         pos = var.posedit.pos.start.base
         end = var.posedit.pos.end.base
@@ -79,6 +95,13 @@ async def fix_coordinates_with_allele(limiter, coords, alleles):
     fix_coordinates_with_allele(["chr1:10000"], ["del(1)"])
     fix_coordinates_with_allele(["chr1:10000"], ["ins(ATG)"])
     """
+    regions = []
+    for coord, allele in zip(coords, alleles):
+        chrom, start = coord.split(':')
+        chrom = chrom.upper().replace('CHR', '')
+        regions += allele_regions(chrom, int(start), int(start), allele)
+    await prefetch_sequences(limiter, regions)
+    
     chroms, positions, refs, alts = [], [], [], []
     for coord, allele in zip(coords, alleles):
         chrom, start = coord.split(':')
@@ -0,0 +1,404 @@
+# offline VEP-style consequence annotation from local transcript models, so
+# annotating variants doesn't depend on the Ensembl REST API
+
+import gzip
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from intervaltree import IntervalTree
+
+from dnm_cohorts.de_novo import revcomp
+from dnm_cohorts.ensembl import most_severe
+
+BASES = 'TCAG'
+AMINO_ACIDS = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+CODONS = dict(zip([a + b + c for a in BASES for b in BASES for c in BASES],
+    AMINO_ACIDS))
+
+ATTRIBUTE = re.compile(r'(\S+) "([^"]*)"')
+
+class Transcript:
+    ''' transcript model, with exons and coding regions on genome coordinates
+    '''
+    def __init__(self, transcript_id, chrom, strand):
+        self.transcript_id = transcript_id
+        self.chrom = chrom
+        self.strand = strand
+        self.start = None
+        self.end = None
+        self.biotype = ''
+        self.symbol = ''
+        self.symbol_source = ''
+        self.exons = []
+        self.cds = []
+
+    def add_region(self, feature, start, end):
+        if feature == 'exon':
+            self.exons.append((start, end))
+        else:
+            self.cds.append((start, end))
+
+    def finalise(self):
+        ''' sort the regions, once every feature has been added
+        '''
+        self.exons = sorted(self.exons)
+        self.cds = merge_regions(self.cds)
+        if self.start is None:
+            self.start = self.exons[0][0]
+            self.end = max(x[1] for x in self.exons)
+
+def merge_regions(regions):
+    ''' merge sorted adjacent regions, e.g. a CDS and the following stop codon
+    '''
+    merged = []
+    for start, end in sorted(regions):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+def overlaps(start, end, a, b):
+    ''' check if a variant overlaps a region
+
+    Insertions have end == start - 1, and overlap a region if inserted between
+    two bases within the region.
+    '''
+    if end < start:
+        return a < start <= b
+    return start <= b and end >= a
+
+def normalise(pos, ref, alt):
+    ''' trim bases shared by ref and alt alleles (e.g. the VCF padding base)
+
+    Returns:
+        tuple of (start, end, ref, alt). Insertions have end == start - 1.
+    '''
+    while ref and alt and ref[0] == alt[0]:
+        ref, alt, pos = ref[1:], alt[1:], pos + 1
+    while ref and alt and ref[-1] == alt[-1]:
+        ref, alt = ref[:-1], alt[:-1]
+    return pos, pos + len(ref) - 1, ref, alt
+
+def open_gtf(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'rt')
+
+def chrom_name(chrom):
+    chrom = chrom.replace('chr', '')
+    return 'MT' if chrom == 'M' else chrom
+
+class GtfAnnotator:
+    ''' annotate VEP consequences and HGNC symbols from a GTF of transcripts
+
+    This follows the VEP consequence definitions for the terms in
+    ensembl.consequences, then picks the most severe consequence and symbol
+    with ensembl.most_severe, as for variants annotated via the REST API. This
+    doesn't model every VEP rule (e.g. regulatory features, or stop codons
+    created by inframe indels), so a few variants can differ from VEP.
+
+    Coding substitutions need reference sequence to find amino acid changes.
+    Without a sequence provider, they are annotated as coding_sequence_variant.
+    '''
+    def __init__(self, path, provider=None, distance=5000):
+        ''' initialize the class object
+
+        Args:
+            path: path to GTF (optionally gzipped), in Ensembl or GENCODE format
+            provider: sequence provider for the same build (see fasta.py)
+            distance: distance from transcripts for upstream and downstream
+                variants (VEP uses 5 kb)
+        '''
+        self.path = path
+        self.provider = provider
+        self.distance = distance
+        self.trees = {}
+
+        transcripts = self._load(path)
+        for tx in transcripts:
+            if tx.chrom not in self.trees:
+                self.trees[tx.chrom] = IntervalTree()
+            self.trees[tx.chrom][tx.start - distance:tx.end + distance + 1] = tx
+        logging.info(f'loaded {len(transcripts)} transcripts from {path}')
+
+    def _load(self, path):
+        transcripts = {}
+        has_hgnc = False
+        with open_gtf(path) as handle:
+            for line in handle:
+                if line.startswith('#'):
+                    continue
+                chrom, _, feature, start, end, _, strand, _, attrs = line.rstrip('\n').split('\t')
+                if feature not in ['transcript', 'exon', 'CDS', 'stop_codon']:
+                    continue
+                attrs = dict(ATTRIBUTE.findall(attrs))
+                tx_id = attrs['transcript_id']
+                start, end = int(start), int(end)
+                if tx_id not in transcripts:
+                    transcripts[tx_id] = Transcript(tx_id, chrom_name(chrom), strand)
+                tx = transcripts[tx_id]
+
+                # Ensembl and GENCODE GTFs repeat the transcript attributes on
+                # every feature, so use them if there is no transcript row
+                if feature == 'transcript' or not tx.symbol:
+                    tx.symbol = attrs.get('gene_name', '')
+                    tx.symbol_source = 'HGNC' if 'hgnc_id' in attrs else ''
+                if feature == 'transcript' or not tx.biotype:
+                    tx.biotype = attrs.get('transcript_biotype', attrs.get('transcript_type', ''))
+                has_hgnc |= 'hgnc_id' in attrs
+
+                if feature == 'transcript':
+                    tx.start, tx.end = start, end
+                else:
+                    tx.add_region(feature, start, end)
+
+        # Ensembl GTFs don't give the gene symbol source, so then treat every
+        # named gene as having an HGNC symbol
+        transcripts = [x for x in transcripts.values() if x.exons]
+        if len(transcripts) == 0:
+            raise ValueError(f'no transcripts with exons found in {path}')
+        for tx in transcripts:
+            tx.finalise()
+            if not has_hgnc and tx.symbol:
+                tx.symbol_source = 'HGNC'
+        return transcripts
+
+    def consequence(self, var):
+        ''' find the most severe consequence and symbol for a variant
+
+        Args:
+            var: object with chrom, pos, ref and alt attributes, on the same
+                genome build as the GTF.
+
+        Returns:
+            tuple of VEP consequence, and hgnc symbol
+        '''
+        start, end, ref, alt = normalise(var.pos, var.ref, var.alt)
+        tree = self.trees.get(chrom_name(str(var.chrom)), IntervalTree())
+
+        transcripts = []
+        for interval in tree.overlap(min(start, end), max(start, end) + 1):
+            tx = interval.data
+            terms = self.transcript_terms(tx, start, end, ref, alt)
+            if terms:
+                transcripts.append({'consequence_terms': terms,
+                    'biotype': tx.biotype, 'gene_symbol': tx.symbol,
+                    'gene_symbol_source': tx.symbol_source})
+
+        if len(transcripts) == 0:
+            return 'intergenic_variant', ''
+        return most_severe({'transcript_consequences': transcripts})
+
+    def transcript_terms(self, tx, start, end, ref, alt):
+        ''' get the consequence terms for a variant in one transcript
+        '''
+        if end >= start and start <= tx.start and end >= tx.end:
+            return ['transcript_ablation']
+
+        if not overlaps(start, end, tx.start, tx.end):
+            if max(start, end) < tx.start:
+                distance, side = tx.start - max(start, end), '+'
+            else:
+                distance, side = min(start, end) - tx.end, '-'
+            if distance > self.distance:
+                return []
+            if side == tx.strand:
+                return ['upstream_gene_variant']
+            return ['downstream_gene_variant']
+
+        terms = set()
+        exonic = any(overlaps(start, end, a, b) for a, b in tx.exons)
+        terms |= self.splice_terms(tx, start, end)
+
+        if not tx.cds:
+            if exonic:
+                terms.add('non_coding_transcript_exon_variant')
+            terms.add('non_coding_transcript_variant')
+        elif any(overlaps(start, end, a, b) for a, b in tx.cds):
+            terms |= self.coding_terms(tx, start, end, ref, alt)
+        elif exonic:
+            before = max(start, end) < tx.cds[0][0]
+            if before == (tx.strand == '+'):
+                terms.add('5_prime_UTR_variant')
+            else:
+                terms.add('3_prime_UTR_variant')
+
+        if tx.biotype == 'nonsense_mediated_decay':
+            terms.add('NMD_transcript_variant')
+        return sorted(terms)
+
+    def splice_terms(self, tx, start, end):
+        ''' get terms for variants in introns and around splice sites
+        '''
+        terms = set()
+        for (_, a), (b, _) in zip(tx.exons, tx.exons[1:]):
+            first, last = a + 1, b - 1
+            if first > last:
+                continue
+            if tx.strand == '+':
+                donor, acceptor = (first, first + 1), (last - 1, last)
+                fifth, donor_region = (first + 4, first + 4), (first + 2, first + 5)
+                polypyrimidine = (last - 16, last - 2)
+            else:
+                donor, acceptor = (last - 1, last), (first, first + 1)
+                fifth, donor_region = (last - 4, last - 4), (last - 5, last - 2)
+                polypyrimidine = (first + 2, first + 16)
+
+            regions = [('intron_variant', (first, last)),
+                ('splice_donor_variant', donor),
+                ('splice_acceptor_variant', acceptor),
+                ('splice_donor_5th_base_variant', fifth),
+                ('splice_donor_region_variant', donor_region),
+                ('splice_polypyrimidine_tract_variant', polypyrimidine),
+                ('splice_region_variant', (first + 2, first + 7)),
+                ('splice_region_variant', (last - 7, last - 2)),
+                ('splice_region_variant', (first - 3, first - 1)),
+                ('splice_region_variant', (last + 1, last + 3))]
+            for term, (x, y) in regions:
+                if overlaps(start, end, x, y):
+                    terms.add(term)
+        return terms
+
+    def coding_terms(self, tx, start, end, ref, alt):
+        ''' get terms for variants within the coding sequence
+        '''
+        cds_start, cds_end = tx.cds[0][0], tx.cds[-1][1]
+        first_codon = (cds_start, cds_start + 2) if tx.strand == '+' else (cds_end - 2, cds_end)
+        last_codon = (cds_end - 2, cds_end) if tx.strand == '+' else (cds_start, cds_start + 2)
+
+        if len(ref) != len(alt):
+            terms = set()
+            diff = len(alt) - len(ref)
+            if diff % 3 != 0:
+                terms.add('frameshift_variant')
+            elif diff > 0:
+                terms.add('inframe_insertion')
+            else:
+                terms.add('inframe_deletion')
+            if end >= start and overlaps(start, end, *first_codon):
+                terms.add('start_lost')
+            if end >= start and overlaps(start, end, *last_codon):
+                terms.add('stop_lost')
+            return terms
+
+        if self.provider is None or tx.chrom not in self.provider:
+            return {'coding_sequence_variant'}
+
+        # find the position of each changed base within the coding sequence
+        offsets = {}
+        index = 0
+        regions = tx.cds if tx.strand == '+' else tx.cds[::-1]
+        for a, b in regions:
+            for pos in range(max(a, start), min(b, end) + 1):
+                base = alt[pos - start]
+                if tx.strand == '+':
+                    offsets[index + pos - a] = base
+                else:
+                    offsets[index + b - pos] = revcomp(base)
+            index += b - a + 1
+
+        seq = ''.join(self.provider.sequence(tx.chrom, a, b) for a, b in tx.cds)
+        if tx.strand == '-':
+            seq = revcomp(seq)
+        mutated = list(seq)
+        for i, base in offsets.items():
+            mutated[i] = base
+        mutated = ''.join(mutated)
+
+        terms = set()
+        for codon in sorted(set(i // 3 for i in offsets)):
+            old = seq[codon * 3:codon * 3 + 3]
+            new = mutated[codon * 3:codon * 3 + 3]
+            if len(old) < 3:
+                terms.add('incomplete_terminal_codon_variant')
+                continue
+            old, new = CODONS.get(old, 'X'), CODONS.get(new, 'X')
+            if 'X' in [old, new]:
+                terms.add('coding_sequence_variant')
+            elif codon == 0 and old == 'M':
+                terms.add('start_retained_variant' if new == 'M' else 'start_lost')
+            elif old == '*':
+                terms.add('stop_retained_variant' if new == '*' else 'stop_lost')
+            elif new == '*':
+                terms.add('stop_gained')
+            elif old != new:
+                terms.add('missense_variant')
+            else:
+                terms.add('synonymous_variant')
+        return terms
+
+    def annotations(self, variants):
+        return [self.consequence(x) for x in variants]
+
+    def annotate(self, variants, processes=1):
+        ''' annotate the consequence and symbol attributes of variants
+
+        Args:
+            variants: list of variants on the same genome build as the GTF
+            processes: number of processes to use
+        '''
+        if processes > 1 and len(variants) > processes:
+            chunks = [variants[i::processes] for i in range(processes)]
+            # the annotator is passed to each worker once when it starts
+            # (inherited without pickling when workers are forked), so only
+            # the variants are sent with each chunk
+            with ProcessPoolExecutor(processes, initializer=_init_worker,
+                    initargs=(self, )) as pool:
+                results = list(pool.map(_worker_annotations, chunks))
+        else:
+            chunks, results = [variants], [self.annotations(variants)]
+
+        for chunk, annotations in zip(chunks, results):
+            for var, (cq, symbol) in zip(chunk, annotations):
+                var.consequence, var.symbol = cq, symbol
+        return variants
+
+# annotator for worker processes, set by _init_worker when each worker starts
+_worker_annotator = None
+
+def _init_worker(annotator):
+    global _worker_annotator
+    _worker_annotator = annotator
+
+def _worker_annotations(variants):
+    return _worker_annotator.annotations(variants)
+
+def annotate_offline(annotators, variants, processes=1):
+    ''' annotate variants with GtfAnnotators for their genome builds
+
+    Variants on a build without an annotator are lifted to a build with one,
+    but keep their original coordinates.
+
+    Args:
+        annotators: dict of GtfAnnotator for each genome build
+        variants: list of DeNovo objects
+        processes: number of processes to use
+
+    Returns:
+        list of variants which couldn't be annotated, as no annotator could be
+        used for them.
+    '''
+    groups = {build: ([], []) for build in annotators}
+    missing = []
+    for var in variants:
+        if var.build in annotators:
+            groups[var.build][0].append(var)
+            groups[var.build][1].append(var)
+            continue
+        for build in annotators:
+            lifted = var.to_build(build)
+            if lifted is not None:
+                groups[build][0].append(var)
+                groups[build][1].append(lifted)
+                break
+        else:
+            missing.append(var)
+
+    for build, (originals, queries) in groups.items():
+        annotators[build].annotate(queries, processes)
+        for var, query in zip(originals, queries):
+            var.consequence, var.symbol = query.consequence, query.symbol
+
+    return missing
@@ -1,11 +1,12 @@
 
 import logging
+from itertools import chain
 
 import trio
-from intervaltree import IntervalTree
 
 from dnm_cohorts.de_novos.jonsson_nature import jonsson_nature_de_novos
 from dnm_cohorts.de_novos.halldorsson_science import halldorsson_science_de_novos
+from dnm_cohorts.sample_identity import find_sample_aliases, best_aliases
 
 async def _get_cohorts():
     ''' get variants from Jonsson et al and Halldorsson et al only
@@ -16,44 +17,6 @@ async def _get_cohorts():
         nursery.start_soon(halldorsson_science_de_novos, variants)
     return variants
 
-def to_intervaltree(de_novos):
-    ''' convert list of de novos in a cohort to intervaltree, for easy indexing
-    '''
-    tree = {}
-    for x in de_novos:
-        if x.chrom not in tree:
-            tree[x.chrom] = IntervalTree()
-        tree[x.chrom].addi(x.pos, x.pos + 1, x.person_id)
-    return tree
-
-def by_sample_id(de_novos):
-    ''' collect de novos by sample for a cohort
-    '''
-    samples = {}
-    for x in de_novos:
-        if x.person_id not in samples:
-            samples[x.person_id] = []
-        samples[x.person_id].append(x)
-    return samples
-
-def count_sample_matches(first, second):
-    ''' count variant matches between samples from two different cohorts
-
-    Args:
-        first: list of variants for sample from one study
-        second: list of variants from second study
-
-    Returns:
-        number of exact matches, and proportion of all variants that matched
-    '''
-    first = set((x.chrom, x.pos, x.ref, x.alt) for x in first if x.chrom != 'X')
-    second = set((x.chrom, x.pos, x.ref, x.alt) for x in second  if x.chrom != 'X')
-
-    intersect = len(first & second)
-    union = len(first | second)
-
-    return intersect, intersect / union
-
 def find_jonsson_to_halldorsson_ids(jonsson, halldorsson):
     ''' find which samples from Jonsson et al are in Haldorsson et al
 
@@ -73,6 +36,9 @@ def find_jonsson_to_halldorsson_ids(jonsson, halldorsson):
     but without matching calls between replicates. This effectively demonstrates
     that Jonsson et al has been superceded by Halldorsson et al.
 
+    This uses the general matching in dnm_cohorts.sample_identity, restricted
+    to these two studies.
+
     Args:
         jonsson: list of DeNovos for Jonsson et al
         halldorsson: list of DeNovos for Halldorsson et al
@@ -80,31 +46,15 @@ def find_jonsson_to_halldorsson_ids(jonsson, halldorsson):
     Returns:
         dict mapping Jonsson sample ID to Halldorsson sample ID
     '''
-    # index halldorsson by chrom and position, to quickly get variant matches
-    halldorsson_tree = to_intervaltree(halldorsson)
-
-    # group variants by sample
-    jonsson_samples = by_sample_id(jonsson)
-    halldorsson_samples = by_sample_id(halldorsson)
-
+    aliases = find_sample_aliases(chain(jonsson, halldorsson))
+    jonsson_samples = set(x.person_id for x in jonsson)
+    
     sample_map = {}
-    for sample in jonsson_samples:
-        has_match = False
-        for var in jonsson_samples[sample]:
-            if has_match:
-                break
-            if var.chrom == 'X':
-                continue
-
-            matches = halldorsson_tree[var.chrom][var.pos]
-            if len(matches) != 1:
-                continue
-
-            match = next(iter(matches)).data
-            count, fraction = count_sample_matches(jonsson_samples[sample], halldorsson_samples[match])
-            has_match = count >= 5 and fraction > 0.4
-            if has_match:
-                sample_map[sample] = match
+    for x in best_aliases(aliases):
+        if x.person_b in jonsson_samples:
+            sample_map[x.person_b] = x.person_a
+        elif x.person_a in jonsson_samples:
+            sample_map[x.person_a] = x.person_b
     
     pct = (len(sample_map) / len(jonsson_samples)) * 100
     logging.info(f'{len(sample_map)} of the {len(jonsson_samples)} ({pct:.3g}%) Jonsson samples exist in Halldorsson et al.')
@@ -0,0 +1,159 @@
+# functions to add a single new study to a previously merged dataset, without
+# reloading and merging every other study
+
+import sqlite3
+from itertools import groupby
+
+from dnm_cohorts.de_novo import DeNovo
+from dnm_cohorts.person import Person
+from dnm_cohorts.exclude_duplicates import (merge_person_dnms,
+    drop_inperson_duplicates)
+
+PERSON_COLUMNS = ['person_id', 'sex', 'phenotype', 'studies']
+DE_NOVO_COLUMNS = ['person_id', 'chrom', 'pos', 'ref', 'alt', 'studies',
+    'confidence', 'build', 'symbol', 'consequence']
+CHANGE_COLUMNS = ['change', 'record_type', 'person_id', 'sex', 'phenotype',
+    'chrom', 'pos', 'ref', 'alt', 'studies', 'confidence', 'build', 'symbol',
+    'consequence']
+
+def write_changes(changes, handle):
+    ''' write changed records as a table, with a column per record field
+
+    Persons and de novos share the person_id and studies columns. Columns
+    for the other record type are left blank.
+
+    Args:
+        changes: list of (change, record_type, record) tuples, where record is
+            the tab-separated person or de novo line
+        handle: file handle to write to
+    '''
+    handle.write('\t'.join(CHANGE_COLUMNS) + '\n')
+    for change, record_type, record in changes:
+        columns = PERSON_COLUMNS if record_type == 'person' else DE_NOVO_COLUMNS
+        row = dict(zip(columns, record.split('\t')))
+        row['change'], row['record_type'] = change, record_type
+        handle.write('\t'.join(row.get(x, '') for x in CHANGE_COLUMNS) + '\n')
+
+def parse_person(record):
+    ''' get a Person from a line of the cohort table
+    '''
+    person_id, sex, phenotypes, studies = record.split('\t')
+    return Person(person_id, sex, phenotypes.split(','), studies.split(','))
+
+class MergedDataset:
+    ''' a previously merged cohort and de novo dataset, indexed by person
+
+    The dataset is kept in a SQLite index, with person and de novo records
+    keyed by person ID. Adding a study only reads and rewrites the records for
+    persons in the new study, so once the index is built, a run scales with
+    the new study rather than the whole dataset. Updates are saved by
+    commit(), so the index then matches the new merged dataset, and can be
+    used for the next study.
+    '''
+    def __init__(self, path):
+        ''' initialize the class object
+
+        Args:
+            path: path to the SQLite index (created if it doesn't exist). Use
+                load() to fill a new index from a merged dataset.
+        '''
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS person (
+            person_id TEXT PRIMARY KEY, record TEXT)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS de_novo (
+            person_id TEXT, symbol TEXT, record TEXT)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS de_novo_person ON ' \
+            'de_novo (person_id, symbol)')
+        self.conn.commit()
+        self.changes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *err):
+        self.close()
+
+    def close(self):
+        ''' close the index, dropping any uncommitted updates
+        '''
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM person').fetchone()[0]
+
+    def load(self, persons, de_novos):
+        ''' fill the index from a previously merged cohort and de novos
+        '''
+        self.conn.executemany('INSERT OR REPLACE INTO person VALUES (?, ?)',
+            ((x.person_id, str(x)) for x in persons))
+        self.conn.executemany('INSERT INTO de_novo VALUES (?, ?, ?)',
+            ((x.person_id, x.symbol, str(x)) for x in de_novos))
+        self.conn.commit()
+
+    def add_persons(self, persons):
+        ''' merge persons from a new study into the cohort
+
+        Persons already in the cohort get the phenotypes and studies of the new
+        copy added, as in merge_duplicate_persons.
+        '''
+        for x in persons:
+            row = self.conn.execute('SELECT record FROM person WHERE person_id=?',
+                (x.person_id, )).fetchone()
+            if row is None:
+                self.conn.execute('INSERT INTO person VALUES (?, ?)',
+                    (x.person_id, str(x)))
+                self.changes.append(('added', 'person', str(x)))
+                continue
+
+            before = row[0]
+            kept = parse_person(before)
+            kept.phenotype = sorted(set(kept.phenotype) | set(x.phenotype))
+            kept.studies = sorted(set(kept.studies) | set(x.studies))
+            if str(kept) != before:
+                self.conn.execute('UPDATE person SET record=? WHERE person_id=?',
+                    (str(kept), x.person_id))
+                self.changes.append(('updated', 'person', str(kept)))
+
+    def add_de_novos(self, de_novos):
+        ''' merge de novos from a new study into the dataset
+
+        Only the persons with de novos in the new study are merged. Duplicate
+        variants within each person are merged with the new study's variant
+        kept, then in-person duplicates within genes are dropped again.
+
+        Args:
+            de_novos: list of DeNovo objects, already annotated with symbol and
+                consequence.
+        '''
+        de_novos = sorted(de_novos, key=lambda x: x.person_id)
+        for person_id, group in groupby(de_novos, key=lambda x: x.person_id):
+            rows = self.conn.execute('SELECT record FROM de_novo WHERE ' \
+                'person_id=? ORDER BY rowid', (person_id, ))
+            existing = [DeNovo(*x.split('\t')) for x, in rows]
+            before = set(str(x) for x in existing)
+            merged = merge_person_dnms(existing + list(group))
+            merged = drop_inperson_duplicates(merged)
+            after = set(str(x) for x in merged)
+
+            self.conn.execute('DELETE FROM de_novo WHERE person_id=?', (person_id, ))
+            self.conn.executemany('INSERT INTO de_novo VALUES (?, ?, ?)',
+                ((x.person_id, x.symbol, str(x)) for x in merged))
+            self.changes += [('removed', 'de_novo', x) for x in sorted(before - after)]
+            self.changes += [('added', 'de_novo', x) for x in sorted(after - before)]
+
+    def iter_persons(self):
+        ''' get cohort lines, sorted by person ID
+        '''
+        for record, in self.conn.execute('SELECT record FROM person ORDER BY person_id'):
+            yield record
+
+    def iter_de_novos(self):
+        ''' get de novo lines in the same order as the full build (by person,
+        then symbol)
+        '''
+        query = 'SELECT record FROM de_novo ORDER BY person_id, symbol, rowid'
+        for record, in self.conn.execute(query):
+            yield record
@@ -0,0 +1,249 @@
+# local stand-in for the Ensembl REST API, with canned responses, so the rate
+# limiter and annotation can be benchmarked without using the real service.
+#
+# Run with:
+#     python -m dnm_cohorts.mock_ensembl --port 8000 --latency 0.05 --rate-429 0.01
+# then point dnm_cohorts at it with:
+#     dnm_cohorts de-novos --ensembl-url http://localhost:8000
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from dnm_cohorts.ensembl import consequences
+
+RELEASE = 110
+
+def canned_base(chrom, pos):
+    ''' get a fixed reference base for a site, so overlapping windows agree
+    '''
+    return 'ACGT'[zlib.crc32(f'{chrom}:{pos}'.encode()) % 4]
+
+def canned_sequence(region):
+    ''' get sequence for a region formatted as chrom:start:end:strand, or
+    chrom:start..end:strand
+    '''
+    chrom, span = region.split(':')[:2]
+    if '..' in span:
+        start, end = map(int, span.split('..'))
+    else:
+        start, end = map(int, region.split(':')[1:3])
+    seq = ''.join(canned_base(chrom, pos) for pos in range(start, end + 1))
+    return {'id': f'chromosome:GRCh37:{chrom}:{start}:{end}:1', 'query': region,
+        'molecule': 'dna', 'seq': seq}
+
+def canned_vep(chrom, start, end, alt, variant_id=None):
+    ''' get a VEP result for a variant, with a consequence and gene picked from
+    the variant region, so repeated requests give the same answer, whether
+    they use the GET or POST endpoint
+    '''
+    alt = '' if alt == '-' else alt
+    value = zlib.crc32(f'{chrom}:{start}:{end}:{alt}'.encode())
+    if value % 10 == 0:
+        return {'id': variant_id, 'input': variant_id,
+            'most_severe_consequence': 'intergenic_variant'}
+    cq = consequences[value % len(consequences)]
+    gene = f'GENE{start // 100000}'
+    return {'id': variant_id, 'input': variant_id, 'most_severe_consequence': cq,
+        'transcript_consequences': [{'consequence_terms': [cq],
+            'biotype': 'protein_coding', 'gene_symbol': gene,
+            'gene_symbol_source': 'HGNC'}]}
+
+class Quota:
+    ''' fixed-window request quota, matching the Ensembl X-RateLimit headers
+    '''
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+        self.window = time.monotonic()
+        self.used = 0
+
+    def take(self):
+        ''' use one request from the quota
+
+        Returns:
+            tuple of (allowed, headers)
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window >= self.period:
+                self.window, self.used = now, 0
+            reset = self.period - (now - self.window)
+            allowed = self.used < self.limit
+            self.used += allowed
+            headers = {'X-RateLimit-Limit': self.limit,
+                'X-RateLimit-Period': self.period,
+                'X-RateLimit-Remaining': self.limit - self.used,
+                'X-RateLimit-Reset': int(reset + 0.999)}
+            return allowed, headers
+
+class Handler(BaseHTTPRequestHandler):
+    ''' handle requests for the endpoints dnm_cohorts uses
+
+    Settings are on the server object: latency (seconds), jitter (seconds),
+    rate_429 and rate_503 (fraction of requests failing with that status),
+    retry_after (seconds) and quota (Quota object, or None).
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def fault(self):
+        ''' delay the response, and check if the request should fail
+
+        Returns:
+            tuple of (status code or None, response headers)
+        '''
+        server = self.server
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        headers = {}
+        if server.quota is not None:
+            allowed, headers = server.quota.take()
+            if not allowed:
+                headers['Retry-After'] = headers['X-RateLimit-Reset']
+                return 429, headers
+
+        value = random.random()
+        if value < server.rate_429:
+            headers['Retry-After'] = server.retry_after
+            return 429, headers
+        if value < server.rate_429 + server.rate_503:
+            return 503, headers
+        return None, headers
+
+    def do_GET(self):
+        status, headers = self.fault()
+        if status is not None:
+            return self.send_json(status, {'error': 'injected failure'}, headers)
+
+        path = self.path.split('?')[0].strip('/').split('/')
+        if path[:3] == ['vep', 'human', 'region'] and len(path) == 5:
+            chrom, start, end = path[3].split(':')[:3]
+            return self.send_json(200, [canned_vep(chrom, int(start), int(end),
+                path[4], f'{chrom}:{start}:{end}/{path[4]}')], headers)
+        if path[:3] == ['sequence', 'region', 'human'] and len(path) == 4:
+            return self.send_json(200, canned_sequence(path[3]), headers)
+        if path == ['info', 'data']:
+            return self.send_json(200, {'releases': [RELEASE]}, headers)
+        self.send_json(404, {'error': f'page not found: {self.path}'}, headers)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = json.loads(self.rfile.read(length) or b'{}')
+        status, headers = self.fault()
+        if status is not None:
+            return self.send_json(status, {'error': 'injected failure'}, headers)
+
+        path = self.path.split('?')[0].strip('/').split('/')
+        if path == ['vep', 'human', 'region']:
+            results = []
+            for line in data.get('variants', []):
+                chrom, pos, var_id, ref, alt = line.split()[:5]
+                end = int(pos) + len(ref) - 1
+                results.append(canned_vep(chrom, int(pos), end, alt, var_id))
+            return self.send_json(200, results, headers)
+        if path == ['sequence', 'region', 'human']:
+            results = [canned_sequence(x) for x in data.get('regions', [])]
+            return self.send_json(200, results, headers)
+        self.send_json(404, {'error': f'page not found: {self.path}'}, headers)
+
+class MockEnsembl:
+    ''' run a mock Ensembl REST server in a background thread
+
+    Examples:
+        with MockEnsembl(latency=0.05, rate_429=0.01) as server:
+            set_base_url(server.url)
+            ...
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+            rate_429=0.0, rate_503=0.0, retry_after=1, limit=None, period=3600):
+        ''' initialize the class object
+
+        Args:
+            host: host to listen on
+            port: port to listen on. Use 0 to pick any free port.
+            latency: seconds to wait before each response
+            jitter: up to this many extra seconds are added to the latency
+            rate_429: fraction of requests to fail with 429 (too many requests)
+            rate_503: fraction of requests to fail with 503 (service unavailable)
+            retry_after: retry-after header for injected 429 responses
+            limit: requests allowed per period, or None for no quota
+            period: seconds in each quota period
+        '''
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.jitter = jitter
+        self.server.rate_429 = rate_429
+        self.server.rate_503 = rate_503
+        self.server.retry_after = retry_after
+        self.server.quota = None if limit is None else Quota(limit, period)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+            daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *err):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Runs a local mock of the ' \
+        'Ensembl REST endpoints used by dnm_cohorts, for benchmarking.')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds to wait before each response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='up to this many extra seconds are added to the latency')
+    parser.add_argument('--rate-429', type=float, default=0.0,
+        help='fraction of requests to fail with 429')
+    parser.add_argument('--rate-503', type=float, default=0.0,
+        help='fraction of requests to fail with 503')
+    parser.add_argument('--retry-after', type=float, default=1,
+        help='retry-after header for injected 429 responses')
+    parser.add_argument('--limit', type=int,
+        help='requests allowed per quota period. Requests over the quota get ' \
+            '429 responses, as for the real server.')
+    parser.add_argument('--period', type=float, default=3600,
+        help='seconds in each quota period')
+    return parser.parse_args()
+
+def main():
+    args = get_options()
+    server = MockEnsembl(args.host, args.port, args.latency, args.jitter,
+        args.rate_429, args.rate_503, args.retry_after, args.limit, args.period)
+    print(f'serving mock Ensembl REST API at {server.url}')
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
+
+if __name__ == '__main__':
+    main()
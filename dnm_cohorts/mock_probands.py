@@ -1,10 +1,8 @@
 
-import random
-
 from dnm_cohorts.person import Person
-from dnm_cohorts.random_id import random_id
+from dnm_cohorts.random_id import cohort_rng, random_ids
 
-def add_mock_probands(persons, required, prefix, suffix, phenotype, study):
+def add_mock_probands(persons, required, prefix, suffix, phenotype, study, rng=None):
     """ include mock probands for those without any de novos
     
     Args:
@@ -14,19 +12,25 @@ def add_mock_probands(persons, required, prefix, suffix, phenotype, study):
         suffix: suffix for mock sample IDs
         phenotype: phenotype of probands (some studies include affected and
             unaffected).
+        rng: numpy.random.Generator for the cohort. If not given, this uses a
+            generator seeded with the first known person in the cohort.
     """
-    # ensure IDs and sexes are repeatable between runs by setting the random
-    # seed with the first known person for each cohort.
-    random.seed(str(min(persons)))
+    # ensure IDs and sexes are repeatable between runs by seeding the random
+    # generator with the first known person for each cohort.
+    if rng is None:
+        rng = cohort_rng(min(persons))
     
     affected = [ x for x in persons if x.phenotype == phenotype ]
     # use the current individuals to estimate the proportion of males, so we
     # can sample according to that fraction, to avoid changing the ratio.
     male_ratio = sum(x.sex == 'male' for x in affected)/len(affected)
     
-    for x in range(required - len(affected)):
-        person_id = f'{prefix}_{random_id()}|{suffix}'
-        sex = 'male' if random.random() < male_ratio else 'female'
+    count = max(required - len(affected), 0)
+    ids = random_ids(rng, count)
+    is_male = rng.random(count) < male_ratio
+    for random_id, male in zip(ids, is_male):
+        person_id = f'{prefix}_{random_id}|{suffix}'
+        sex = 'male' if male else 'female'
         person = Person(person_id, sex, phenotype, study)
         persons.add(person)
     
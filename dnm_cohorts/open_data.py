@@ -1,5 +1,9 @@
 
 import gzip
+import json
+import os
+from collections import Counter
+from types import MappingProxyType
 from pkg_resources import resource_filename
 
 # import pandas
@@ -40,5 +44,105 @@ def open_cohort(path=None):
             cohort.append(Person(person_id, sex, phenotypes, studies))
         return cohort
 
+def summarise_cohort(persons):
+    ''' count persons by sex, phenotype and study in a single pass
+    
+    Returns:
+        dict of Counters, with keys for 'sex', 'phenotype', 'study', and
+        'phenotype_sex' (which has a Counter of sexes for each phenotype)
+    '''
+    sexes, phenotypes, studies = Counter(), Counter(), Counter()
+    phenotype_sex = {}
+    for person in persons:
+        sexes[person.sex] += 1
+        studies.update(person.studies)
+        for term in person.phenotype:
+            phenotypes[term] += 1
+            if term not in phenotype_sex:
+                phenotype_sex[term] = Counter()
+            phenotype_sex[term][person.sex] += 1
+    
+    return {'sex': sexes, 'phenotype': phenotypes, 'study': studies,
+            'phenotype_sex': phenotype_sex}
+
+def summary_path(path):
+    ''' get the path to the summary file stored alongside a cohort file
+    '''
+    return f'{path}.summary.json'
+
+def read_summary(path, stat):
+    ''' read a stored cohort summary, if it matches the cohort file
+    
+    Returns:
+        dict of Counters (see summarise_cohort), or None if there isn't a
+        summary for the current version of the cohort file
+    '''
+    try:
+        with open(summary_path(path), 'rt') as handle:
+            data = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if data.get('mtime_ns') != stat.st_mtime_ns or data.get('size') != stat.st_size:
+        return None
+    tables = data['summary']
+    return {'sex': Counter(tables['sex']),
+        'phenotype': Counter(tables['phenotype']),
+        'study': Counter(tables['study']),
+        'phenotype_sex': {k: Counter(v) for k, v in tables['phenotype_sex'].items()}}
+
+def write_summary(path, stat, summary):
+    ''' store a cohort summary alongside the cohort file
+    
+    The summary is skipped if the cohort directory isn't writable (e.g. the
+    bundled cohort in a system-wide install).
+    '''
+    data = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'summary': summary}
+    temp = f'{summary_path(path)}.{os.getpid()}.tmp'
+    try:
+        with open(temp, 'wt') as handle:
+            json.dump(data, handle)
+        os.replace(temp, summary_path(path))
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def read_only(summary):
+    ''' wrap summary tables so callers can't alter the cached copy
+    '''
+    phenotype_sex = {k: MappingProxyType(v) for k, v in summary['phenotype_sex'].items()}
+    return MappingProxyType({'sex': MappingProxyType(summary['sex']),
+        'phenotype': MappingProxyType(summary['phenotype']),
+        'study': MappingProxyType(summary['study']),
+        'phenotype_sex': MappingProxyType(phenotype_sex)})
+
+_summaries = {}
+
+def cohort_summary(path=None):
+    ''' get denominators for the cohort, by sex, phenotype and study
+    
+    The tables are computed once per cohort file and stored alongside it (as
+    <path>.summary.json), so later calls, including from other processes,
+    don't iterate through the cohort again. The stored summary records the
+    cohort file modification time and size, so rebuilding the cohort file
+    refreshes the summary. Tables are read-only, and missing keys count as 0.
+    
+    Examples:
+        summary = cohort_summary()
+        summary['phenotype']['HP:0001249']
+        summary['phenotype_sex']['HP:0000717']['male']
+    '''
+    path = os.path.abspath(path or COHORT_PATH)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _summaries:
+        summary = read_summary(path, stat)
+        if summary is None:
+            # the bundled cohort is already loaded
+            persons = cohort if path == os.path.abspath(COHORT_PATH) else open_cohort(path)
+            summary = summarise_cohort(persons)
+            write_summary(path, stat, summary)
+        _summaries[key] = read_only(summary)
+    return _summaries[key]
+
 de_novos = open_de_novos()
 cohort = open_cohort()
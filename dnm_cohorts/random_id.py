@@ -1,12 +1,36 @@
 
+import hashlib
 import random
 
-def random_id(size=12):
+import numpy
+
+HEX_DIGITS = numpy.array(list('0123456789abcdef'))
+
+def cohort_rng(seed):
+    """ get an independent random number generator for a cohort
+    
+    Each cohort loader draws from its own generator, rather than seeding the
+    global random module, so loaders give the same results whatever order (or
+    thread) they run in. python's hash() is salted per process, so the seed is
+    converted to an integer via a stable digest instead.
+    
+    Args:
+        seed: any object with a stable string representation, e.g. a study DOI
+    
+    Returns:
+        numpy.random.Generator
+    """
+    digest = hashlib.sha256(str(seed).encode('utf8')).digest()
+    return numpy.random.default_rng(int.from_bytes(digest[:8], 'little'))
+
+def random_id(size=12, rng=random):
     """ make a random character string for semi-unique IDs
     
     Args:
         size: length of string to return. 12 characters should mean a 50% chance
         of string collisions only after 20 million random strings.
+        rng: source of random bits, defaults to the global random module, but
+            can be any object with a getrandbits method e.g. random.Random
     
     Returns:
         random character string
@@ -23,7 +47,41 @@ def random_id(size=12):
     # the randomness, but enforces evaluation as a string.
     string = None
     while string is None or is_number(string) or len(string) != size:
-        string = f"{random.getrandbits(size*4):x}"
+        string = f"{rng.getrandbits(size*4):x}"
         string = string.strip()
     
     return string
+
+def random_ids(rng, count, size=12):
+    """ make a batch of random hex strings for semi-unique IDs
+    
+    This follows the same rules as random_id (full length, and never parseable
+    as a number), but draws every digit for the batch in one call.
+    
+    Args:
+        rng: numpy.random.Generator, see cohort_rng()
+        count: number of IDs to make
+        size: length of each ID
+    
+    Returns:
+        list of random character strings
+    """
+    ids = []
+    while len(ids) < count:
+        needed = count - len(ids)
+        digits = rng.integers(0, 16, size=(needed, size))
+        # avoid leading zeros, so every string is the full length
+        digits[:, 0] = rng.integers(1, 16, size=needed)
+        
+        # drop strings which python would parse as floats, i.e. all decimal
+        # digits, or decimal digits either side of a single 'e' (e.g. '12e34')
+        is_digit = digits < 10
+        is_exp = digits == 14
+        numeric = (is_digit | is_exp).all(axis=1) & (is_exp.sum(axis=1) <= 1) \
+            & ~is_exp[:, 0] & ~is_exp[:, -1]
+        digits = digits[~numeric]
+        
+        strings = HEX_DIGITS[digits].view(f'<U{size}').ravel()
+        ids += strings.tolist()
+    
+    return ids
@@ -1,63 +1,255 @@
 
-import time
 import logging
+from collections import deque
+from urllib.parse import urlsplit
+
 import trio
 
 import asks
 asks.init('trio')
 
-from dnm_cohorts.rate_limiter_retries import ensembl_retry as retry
+from dnm_cohorts.rate_limiter_retries import (ensembl_retry as retry,
+    CircuitBreaker, RetryBudget)
+from dnm_cohorts.request_metrics import Metrics
+
+class HostLimiter:
+    ''' rate limit and connection pool for requests to a single host
+
+    The request rate and the number of requests in flight adapt to the server
+    with additive-increase/multiplicative-decrease. Both halve after a 429
+    response, and grow slowly after successful responses, up to per_second and
+    max_in_flight. The rate is also capped so the remaining quota from the
+    X-RateLimit headers lasts until the quota resets.
+    '''
+    MAX_TOKENS = 10
+    MIN_RATE = 0.5
+    def __init__(self, host, per_second=10, max_in_flight=50, breaker=None):
+        ''' initialize the class object
+
+        Args:
+            host: host name (and port, if given in the url)
+            per_second: maximum number of queries allowed per second
+            max_in_flight: maximum number of simultaneous requests
+            breaker: dict of options for the host's CircuitBreaker
+        '''
+        self.host = host
+        self.RATE = per_second
+        self.max_rate = per_second
+        self.quota_rate = float('inf')
+        self.max_in_flight = max_in_flight
+        self.in_flight = trio.CapacityLimiter(max_in_flight)
+        self.successes = 0
+        self.tat = float('-inf')
+        self.waiters = deque()
+        self.breaker = CircuitBreaker(host, **(breaker or {}))
+        self.client = asks.Session(connections=max_in_flight)
+
+    async def close(self):
+        await self.client.close()
+
+    def adapt(self, resp):
+        ''' adjust the request rate and concurrency after a response
+        '''
+        headers = {k.lower(): v for k, v in dict(resp.headers).items()}
+        if resp.status_code == 429:
+            self.RATE = max(self.RATE / 2, self.MIN_RATE)
+            self.in_flight.total_tokens = max(self.in_flight.total_tokens // 2, 1)
+            # drop any saved up burst of tokens
+            self.tat = max(self.tat, trio.current_time() + self.MAX_TOKENS / self.RATE)
+            self.successes = 0
+            logging.warning(f'{self.host} rate limited, slowing to {self.RATE:.2g} ' \
+                f'requests/second, {self.in_flight.total_tokens} in flight')
+        elif resp.status_code < 400:
+            # add about one request/second per second of successful requests,
+            # and another request in flight per window of successful requests
+            self.RATE += 1 / self.RATE
+            self.successes += 1
+            if self.successes >= self.in_flight.total_tokens:
+                self.successes = 0
+                self.in_flight.total_tokens = min(self.in_flight.total_tokens + 1,
+                    self.max_in_flight)
+        
+        # spread the remaining quota over the time until the quota resets
+        try:
+            if 'x-ratelimit-remaining' in headers and 'x-ratelimit-reset' in headers:
+                reset = max(float(headers['x-ratelimit-reset']), 1)
+                self.quota_rate = float(headers['x-ratelimit-remaining']) / reset
+            elif 'x-ratelimit-limit' in headers and 'x-ratelimit-period' in headers:
+                period = max(float(headers['x-ratelimit-period']), 1)
+                self.quota_rate = float(headers['x-ratelimit-limit']) / period
+        except ValueError:
+            logging.warning(f'could not parse rate limit headers: {headers}')
+        self.RATE = max(min(self.RATE, self.max_rate, self.quota_rate), self.MIN_RATE)
+    
+    async def wait_for_token(self):
+        ''' pause until a token is free, in first-come first-served order
+
+        Waiting tasks queue in order. Only the task at the head of the queue
+        sleeps until its exact release time, then hands over to the next task,
+        so a long queue doesn't mean many wakeups.
+        '''
+        if not self.waiters and self.take_token():
+            return
+        
+        event = trio.Event()
+        self.waiters.append(event)
+        if self.waiters[0] is event:
+            event.set()
+        try:
+            await event.wait()
+            # recheck after sleeping, in case the rate dropped in the meantime
+            while not self.take_token():
+                await trio.sleep_until(self.next_release())
+        finally:
+            head = self.waiters[0] is event
+            self.waiters.remove(event)
+            if head and self.waiters:
+                self.waiters[0].set()
+
+    def take_token(self):
+        ''' take a token if one is free now
+
+        This uses the generic cell rate algorithm, tracking the theoretical
+        arrival time (tat) of the next request, rather than a count of tokens.
+        Up to MAX_TOKENS requests can be sent in a burst.
+        '''
+        now = trio.current_time()
+        tat = max(self.tat, now)
+        if tat - now > (self.MAX_TOKENS - 1) / self.RATE:
+            return False
+        self.tat = tat + 1 / self.RATE
+        return True
+
+    def next_release(self):
+        ''' find when the next token will be free
+        '''
+        return self.tat - (self.MAX_TOKENS - 1) / self.RATE
 
 class RateLimiter:
     ''' class to asynchronously perform http get requests
 
     This respects the rate limits imposed by the server. Error handling and
     retrying are handled by the 'retry' decorator.
+
+    Each host (e.g. grch37.rest.ensembl.org and rest.ensembl.org) has its own
+    rate limit and connection pool (see HostLimiter), since each host has its
+    own quota.
+
+    Request counts, bytes, status codes, retries and timings are collected per
+    endpoint in self.metrics, see snapshot().
+
+    Retries draw from a retry budget shared by every request, and each host has
+    a circuit breaker, so during an outage requests pause, then fail fast,
+    rather than every request retrying independently (see ensembl_retry).
     '''
-    MAX_TOKENS = 10
-    def __init__(self, per_second=10):
+    def __init__(self, per_second=10, max_in_flight=50, metrics=None,
+            retry_ratio=0.2, breaker_threshold=0.5, breaker_window=20,
+            breaker_cooldown=5, breaker_max_pause=900):
         ''' initialize the class object
 
         Args:
-            per_second: number of queries allowed per second
+            per_second: maximum number of queries allowed per second, per host
+            max_in_flight: maximum number of simultaneous requests, per host
+            metrics: Metrics object to collect request metrics in, so metrics
+                can be shared between RateLimiters. Defaults to a new object.
+            retry_ratio: retries allowed as a fraction of requests
+            breaker_threshold: fraction of recent requests to a host which
+                must fail to open its circuit breaker
+            breaker_window: number of recent requests checked for failures
+            breaker_cooldown: seconds to pause requests once a breaker opens
+            breaker_max_pause: seconds a breaker can stay open before requests
+                fail fast
         '''
-        self.tokens = self.MAX_TOKENS
-        self.RATE = per_second
-        self.updated_at = time.monotonic()
+        self.per_second = per_second
+        self.max_in_flight = max_in_flight
+        self.metrics = Metrics() if metrics is None else metrics
+        self.retry_budget = RetryBudget(retry_ratio)
+        self.breaker_options = {'threshold': breaker_threshold,
+            'window': breaker_window, 'cooldown': breaker_cooldown,
+            'max_pause': breaker_max_pause}
+        self.hosts = {}
         self.count = 0
+        self.pending = {}
     async def __aenter__(self):
-        self.client = asks.Session(connections=50)
         return self
     async def __aexit__(self, *err):
-        await self.client.close()
-        self.client = None
+        self.snapshot()
+        for host in self.hosts.values():
+            await host.close()
+        self.hosts = {}
+
+    def snapshot(self):
+        ''' get request metrics per endpoint, and the current rate per host
+        '''
+        for host in self.hosts.values():
+            self.metrics.hosts[host.host] = {'rate': host.RATE,
+                'in_flight_limit': host.in_flight.total_tokens,
+                'breaker': host.breaker.state, 'breaker_trips': host.breaker.trips}
+        return self.metrics.snapshot()
+
+    def host(self, url):
+        ''' get the rate limiter for the host of a url
+        '''
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(host, self.per_second,
+                self.max_in_flight, self.breaker_options)
+        return self.hosts[host]
+
+    def breaker(self, url):
+        ''' get the circuit breaker for the host of a url
+        '''
+        return self.host(url).breaker
 
-    @retry(retries=9)
     async def get(self, url, *args, **kwargs):
         ''' perform asynchronous http get
 
+        Concurrent requests for the same url (and options) share one request,
+        so duplicates don't use up rate limit tokens. The response, or the error
+        after retries, goes to every caller.
+
         Args:
             url: url to get
             headers: http headers to pass in with the get query
         '''
+        key = (url, repr(args), repr(sorted(kwargs.items())))
+        while key in self.pending:
+            entry = self.pending[key]
+            self.metrics.coalesced(url)
+            await entry['done'].wait()
+            if 'result' in entry:
+                return entry['result']
+            if 'error' in entry:
+                raise entry['error']
+            # the shared request was cancelled, so make the request ourselves
+        
+        entry = {'done': trio.Event()}
+        self.pending[key] = entry
+        try:
+            entry['result'] = await self._get(url, *args, **kwargs)
+            return entry['result']
+        except Exception as err:
+            entry['error'] = err
+            raise
+        finally:
+            del self.pending[key]
+            entry['done'].set()
+    
+    @retry(retries=9)
+    async def _get(self, url, *args, **kwargs):
         if 'headers' not in kwargs:
             kwargs['headers'] = {'content-type': 'application/json'}
         if 'params' not in kwargs:
             kwargs['params'] = {}
-        await self.wait_for_token()
-        try:
-            resp = await self.client.get(url, *args, **kwargs)
-        except Exception as err:
-            logging.error(f'problem accessing {url}: {err}')
-            raise
-        logging.info(f'{url}\t{resp.status_code}')
-        resp.raise_for_status()
-        return resp.text
+        return await self._request('get', url, *args, **kwargs)
     
-    @retry(retries=3)
+    @retry(retries=3, retry_bad_request=False)
     async def post(self, url, *args, **kwargs):
         ''' perform asynchronous http post
 
+        400 responses aren't retried, since the server rejects a POST for its
+        content (e.g. a variant VEP can't parse), so a retry fails the same way.
+
         Args:
             url: url to get
             headers: http headers to pass in with the get query
@@ -66,26 +258,26 @@ class RateLimiter:
             kwargs['headers'] = {'content-type': 'application/json'}
         if 'data' not in kwargs:
             kwargs['data'] = {}
-        await self.wait_for_token()
-        resp = await self.client.post(url, *args, **kwargs)
+        return await self._request('post', url, *args, **kwargs)
+
+    async def _request(self, method, url, *args, **kwargs):
+        ''' send a request once the host's rate limit allows, and record metrics
+        '''
+        host = self.host(url)
+        start = trio.current_time()
+        await host.wait_for_token()
+        sent = trio.current_time()
+        try:
+            async with host.in_flight:
+                sent = trio.current_time()
+                resp = await getattr(host.client, method)(url, *args, **kwargs)
+        except Exception as err:
+            self.metrics.error(url, sent - start, trio.current_time() - sent)
+            logging.error(f'problem accessing {url}: {err}')
+            raise
+        self.metrics.response(url, resp.status_code, len(resp.content),
+            sent - start, trio.current_time() - sent)
         logging.info(f'{url}\t{resp.status_code}')
+        host.adapt(resp)
         resp.raise_for_status()
         return resp.text
-
-    async def wait_for_token(self):
-        ''' pause until tokens are refilled
-        '''
-        while self.tokens < 1:
-            self.add_new_tokens()
-            await trio.sleep(1 / self.RATE)
-        self.tokens -= 1
-
-    def add_new_tokens(self):
-        ''' add new tokens if sufficient time has passed
-        '''
-        now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.RATE
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.MAX_TOKENS)
-            self.updated_at = now
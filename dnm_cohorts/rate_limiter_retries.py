@@ -1,42 +1,213 @@
 
 import trio
 import random
+import logging
 import functools
+from collections import deque
 
 from asks.errors import (RequestTimeout, ServerClosedConnectionError, BadStatus,
     BadHttpResponse)
 
-def ensembl_retry(retries=5):
+class CircuitOpenError(Exception):
+    pass
+
+class RetryBudget:
+    ''' limit retries to a fraction of requests, shared between every request
+
+    Each request adds `ratio` tokens, and each retry uses one token, so during
+    an outage retries stop once they reach that fraction of requests, rather
+    than every request retrying independently.
+    '''
+    def __init__(self, ratio=0.2, min_tokens=10, max_tokens=1000):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class CircuitBreaker:
+    ''' circuit breaker for requests to one host
+
+    The breaker opens once at least `threshold` of the last `window` requests
+    failed with server errors. While open, requests pause until a cooldown
+    passes, then a single probe request is let through (half-open). If the
+    probe succeeds, the breaker closes and paused requests resume. If it fails,
+    the breaker opens again, with double the cooldown. If the breaker has been
+    open for longer than max_pause, requests fail fast with CircuitOpenError.
+    '''
+    def __init__(self, host, threshold=0.5, window=20, cooldown=5,
+            max_cooldown=120, max_pause=900, probe_timeout=120):
+        self.host = host
+        self.threshold = threshold
+        self.outcomes = deque(maxlen=window)
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_pause = max_pause
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.opened_at = None
+        self.retry_at = None
+        self.probe_at = None
+        self.trips = 0
+        self.changed = trio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = trio.Event()
+
+    async def wait(self):
+        ''' pause while the breaker is open
+
+        Raises:
+            CircuitOpenError if the breaker has been open too long
+        '''
+        while self.state != 'closed':
+            now = trio.current_time()
+            if now - self.opened_at > self.max_pause:
+                raise CircuitOpenError(f'{self.host} has been failing for ' \
+                    f'{now - self.opened_at:.0f} seconds')
+            if self.state == 'open' and now >= self.retry_at:
+                # this request is the probe
+                self.state, self.probe_at = 'half-open', now
+                return
+            if self.state == 'half-open' and now >= self.probe_at + self.probe_timeout:
+                # the probe never finished, so send another
+                self.probe_at = now
+                return
+            deadline = self.retry_at if self.state == 'open' else \
+                self.probe_at + self.probe_timeout
+            with trio.move_on_at(deadline):
+                await self.changed.wait()
+
+    def success(self):
+        self.outcomes.append(True)
+        if self.state == 'half-open':
+            logging.warning(f'{self.host} is responding again, resuming requests')
+            self.state = 'closed'
+            self.opened_at = None
+            self.cooldown = self.base_cooldown
+            self.outcomes.clear()
+            self.notify()
+
+    def failure(self):
+        self.outcomes.append(False)
+        if self.state == 'half-open':
+            self.trip()
+        elif self.state == 'closed' and len(self.outcomes) == self.outcomes.maxlen \
+                and self.outcomes.count(False) >= self.threshold * len(self.outcomes):
+            self.trip()
+
+    def trip(self):
+        now = trio.current_time()
+        logging.warning(f'{self.host} is failing, pausing requests for ' \
+            f'{self.cooldown} seconds')
+        self.state = 'open'
+        self.opened_at = now if self.opened_at is None else self.opened_at
+        self.retry_at = now + self.cooldown
+        self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        self.trips += 1
+        self.outcomes.clear()
+        self.notify()
+
+def record_retry(args, reason):
+    ''' count a retry, if the decorated method is on an object with metrics
+    '''
+    metrics = getattr(args[0], 'metrics', None) if len(args) > 1 else None
+    if metrics is not None:
+        metrics.retry(args[1], reason)
+
+def get_breaker(args):
+    ''' get the circuit breaker for the url host, if the decorated method is on
+    an object with circuit breakers (e.g. RateLimiter)
+    '''
+    breaker = getattr(args[0], 'breaker', None) if len(args) > 1 else None
+    return None if breaker is None else breaker(args[1])
+
+def ensembl_retry(retries=5, retry_bad_request=True):
     ''' perform all the error handling for the request
-    
+
     retries up to N times under certain error conditions, and increases waiting
     time between requests, unless we've hit rate limits, when it uses the stated
-    retry time.
+    retry time. 400 responses are retried unless retry_bad_request is False
+    (e.g. for requests which the server can reject for their content).
+
+    If the decorated method is on an object with a retry budget and circuit
+    breakers (see RateLimiter), retries (except after 429 responses) draw from
+    the shared budget, and requests pause or fail fast while the host's
+    circuit breaker is open.
     '''
     def decorator(func):
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             result = None
             last_exception = None
+            breaker = get_breaker(args)
+            budget = getattr(args[0], 'retry_budget', None) if args else None
+            if budget is not None:
+                budget.deposit()
             for i in range(retries):
+                if breaker is not None:
+                    await breaker.wait()
                 try:
-                    return await func(*args, **kwargs)
+                    result = await func(*args, **kwargs)
+                    if breaker is not None:
+                        breaker.success()
+                    return result
                 # except (ServerDisconnectedError, ClientOSError, RequestTimeout) as err:
                 except (ServerClosedConnectionError, RequestTimeout) as err:
                     last_exception = err
+                    reason = type(err).__name__
                     delay = 0
                 except BadHttpResponse as err:
                     last_exception = err
+                    reason = 'BadHttpResponse'
                     delay = 1
                 except BadStatus as err:
                     last_exception = err
                     # 500, 503, 504 are server down issues. 429 exceeds rate
                     # limits. 400 is server memory issue. Raises other errors.
-                    if err.status_code not in [500, 503, 504, 429, 400]:
+                    if err.status_code not in [500, 503, 504, 429, 400] or \
+                            (err.status_code == 400 and not retry_bad_request):
+                        if breaker is not None:
+                            breaker.success()
                         raise err
+                    reason = f'status_{err.status_code}'
                     delay = random.uniform(0, 2 ** (i + 2))
                     if err.status_code == 429:
                         delay = float(dict(err.response.headers)['retry-after'])
+                except Exception:
+                    # errors which aren't retried (e.g. a refused connection)
+                    # still count against the host, and end any probe
+                    if breaker is not None:
+                        breaker.failure()
+                    raise
+
+                # rate limiting isn't a failure, the server is working as
+                # expected, so this also ends a probe. Retries while the
+                # breaker is open wait for the breaker instead of using the
+                # budget.
+                if reason == 'status_429':
+                    if breaker is not None:
+                        breaker.success()
+                else:
+                    paused = False
+                    if breaker is not None:
+                        breaker.failure()
+                        paused = breaker.state != 'closed'
+                    if budget is not None and i < retries - 1 and not paused \
+                            and not budget.withdraw():
+                        logging.warning(f'retry budget exhausted, not retrying: {last_exception}')
+                        break
+                if i < retries - 1:
+                    record_retry(args, reason)
                 await trio.sleep(delay)
             if last_exception is not None:
                 raise last_exception
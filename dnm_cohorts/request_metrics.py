@@ -0,0 +1,116 @@
+# request metrics for the RateLimiter, to see where time goes when using the
+# Ensembl REST API
+
+import json
+from collections import Counter
+from urllib.parse import urlsplit
+
+# upper bounds (in seconds) for the latency histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+
+def endpoint(url):
+    ''' get the endpoint for a url, without the variable parts of the path
+
+    Examples:
+        endpoint('https://rest.ensembl.org/vep/human/region/1:100:100/G')
+        # 'rest.ensembl.org/vep/human/region'
+    '''
+    parts = urlsplit(url)
+    path = []
+    for x in parts.path.strip('/').split('/'):
+        if ':' in x:
+            break
+        path.append(x)
+    return parts.netloc + '/' + '/'.join(path)
+
+class Histogram:
+    ''' latency histogram, with counts in fixed buckets
+    '''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[next(i for i, x in enumerate(BUCKETS) if value <= x)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'buckets': {f'le_{x}': n for x, n in zip(BUCKETS, self.counts)}}
+
+class EndpointMetrics:
+    ''' counters for requests to a single endpoint
+    '''
+    def __init__(self):
+        self.requests = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.bytes = 0
+        self.status = Counter()
+        self.retries = Counter()
+        self.token_wait = Histogram()
+        self.in_flight = Histogram()
+
+    def snapshot(self):
+        return {'requests': self.requests, 'coalesced': self.coalesced,
+            'errors': self.errors, 'bytes': self.bytes,
+            'status': {str(k): v for k, v in sorted(self.status.items())},
+            'retries': dict(sorted(self.retries.items())),
+            'token_wait': self.token_wait.snapshot(),
+            'in_flight': self.in_flight.snapshot()}
+
+class Metrics:
+    ''' request metrics, per endpoint, collected by a RateLimiter
+
+    A Metrics object can be shared between RateLimiters, to collect metrics
+    for a whole run.
+    '''
+    def __init__(self):
+        self.endpoints = {}
+        self.hosts = {}
+
+    def __getitem__(self, url):
+        key = endpoint(url)
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointMetrics()
+        return self.endpoints[key]
+
+    def response(self, url, status, size, token_wait, in_flight):
+        ''' record a completed request
+        '''
+        metrics = self[url]
+        metrics.requests += 1
+        metrics.status[status] += 1
+        metrics.bytes += size
+        metrics.token_wait.add(token_wait)
+        metrics.in_flight.add(in_flight)
+
+    def error(self, url, token_wait, in_flight):
+        ''' record a request which failed without a response
+        '''
+        metrics = self[url]
+        metrics.requests += 1
+        metrics.errors += 1
+        metrics.token_wait.add(token_wait)
+        metrics.in_flight.add(in_flight)
+
+    def retry(self, url, reason):
+        self[url].retries[reason] += 1
+
+    def coalesced(self, url):
+        self[url].coalesced += 1
+
+    def snapshot(self):
+        ''' get the current metrics as a dict, which can be saved as JSON
+        '''
+        return {'endpoints': {k: v.snapshot() for k, v in sorted(self.endpoints.items())},
+            'hosts': dict(sorted(self.hosts.items()))}
+
+    def dump(self, handle):
+        json.dump(self.snapshot(), handle, indent=2)
+        handle.write('\n')
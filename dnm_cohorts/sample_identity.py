@@ -0,0 +1,157 @@
+# functions to find samples which occur in more than one study, under different
+# sample IDs, by looking for samples which share de novo calls
+
+import logging
+from collections import Counter, namedtuple
+from itertools import combinations
+
+Alias = namedtuple('Alias', ['study_a', 'person_a', 'study_b', 'person_b',
+    'shared', 'jaccard'])
+
+ALIAS_HEADER = list(Alias._fields)
+
+def variant_key(var):
+    ''' get a key for a de novo call, on grch38 coordinates
+
+    Returns:
+        tuple of (chrom, pos, ref, alt), or None if the variant can't be lifted
+    '''
+    if var.build != 'grch38':
+        var = var.to_build('grch38')
+    if var is None:
+        return None
+    return (var.chrom, var.pos, var.ref, var.alt)
+
+def find_sample_aliases(de_novos, min_shared=5, min_fraction=0.4,
+        max_carriers=10, skip_chroms=('X', )):
+    ''' find likely-identical samples between every pair of studies
+
+    Sample ID schemes differ between studies, so we cannot match by sample IDs.
+    But the chance of two different people having the same de novo call is very
+    low, so samples with a high fraction of matching de novo calls are most
+    likely the same person. See halldorsson_check.py for an example.
+
+    Variants are put into an inverted index from variant key to the samples
+    carrying the variant, and only samples sharing a variant are compared, so
+    this scales to the full dataset, rather than comparing every pair of
+    samples. Variants carried by many samples are uninformative (recurrent
+    mutations or artefacts), so are skipped when counting matches.
+
+    Args:
+        de_novos: iterable of DeNovo objects from any number of studies. Each
+            variant should have a single study, i.e. from before merging.
+        min_shared: minimum number of shared de novos for a match
+        min_fraction: matches need a Jaccard index of shared de novos above this
+        max_carriers: skip variants carried by more samples than this
+        skip_chroms: chromosomes to ignore. ChrX calls are often restricted to
+            females, or handled differently between studies.
+
+    Returns:
+        list of Alias tuples, sorted by decreasing Jaccard index. In each alias,
+        person_a is from the study with more samples, which is most likely the
+        expanded cohort, so person_b can be renamed to person_a.
+    '''
+    carriers = {}
+    counts = Counter()
+    for var in de_novos:
+        if var.chrom in skip_chroms:
+            continue
+        key = variant_key(var)
+        if key is None:
+            continue
+        sample = (var.study, var.person_id)
+        if key not in carriers:
+            carriers[key] = set()
+        if sample not in carriers[key]:
+            carriers[key].add(sample)
+            counts[sample] += 1
+
+    shared = Counter()
+    for samples in carriers.values():
+        if len(samples) < 2 or len(samples) > max_carriers:
+            continue
+        for a, b in combinations(sorted(samples), 2):
+            # samples with the same ID are already merged as the same person
+            if a[0] != b[0] and a[1] != b[1]:
+                shared[(a, b)] += 1
+
+    study_sizes = Counter(study for study, _ in counts)
+    aliases = []
+    for (a, b), n in shared.items():
+        if n < min_shared:
+            continue
+        jaccard = n / (counts[a] + counts[b] - n)
+        if jaccard <= min_fraction:
+            continue
+        if (study_sizes[a[0]], a[0]) < (study_sizes[b[0]], b[0]):
+            a, b = b, a
+        aliases.append(Alias(a[0], a[1], b[0], b[1], n, jaccard))
+
+    logging.info(f'found {len(aliases)} likely sample aliases between studies')
+    return sorted(aliases, key=lambda x: (-x.jaccard, -x.shared, x))
+
+def best_aliases(aliases):
+    ''' restrict aliases to the best match for each sample in each other study
+
+    Aliases are taken in order of decreasing score, and skipped if either
+    sample already has a better match in the other study. A sample can still
+    match samples in several other studies.
+    '''
+    used = set()
+    best = []
+    for alias in sorted(aliases, key=lambda x: (-x.jaccard, -x.shared, x)):
+        a = (alias.person_a, alias.study_b)
+        b = (alias.person_b, alias.study_a)
+        if a in used or b in used:
+            continue
+        used |= {a, b}
+        best.append(alias)
+    return best
+
+def alias_map(aliases):
+    ''' get dict mapping the renamed person IDs to the IDs they merge into
+    '''
+    mapping = {}
+    for x in best_aliases(aliases):
+        if x.person_b not in mapping:
+            mapping[x.person_b] = x.person_a
+
+    # resolve chains, where a sample is matched in three or more studies
+    for k, v in mapping.items():
+        seen = {k}
+        while v in mapping and v not in seen:
+            seen.add(v)
+            v = mapping[v]
+        mapping[k] = v
+    return mapping
+
+def rename_aliases(items, mapping):
+    ''' rename person IDs (for DeNovo or Person objects) to the merged ID
+
+    Objects are hashed by their person ID, so this returns a new list rather
+    than altering objects inside an existing set.
+    '''
+    items = list(items)
+    for x in items:
+        x.person_id = mapping.get(x.person_id, x.person_id)
+    return items
+
+def write_aliases(aliases, handle):
+    ''' write a table of aliases to an open file handle
+    '''
+    handle.write('\t'.join(ALIAS_HEADER) + '\n')
+    for x in aliases:
+        handle.write(f'{x.study_a}\t{x.person_a}\t{x.study_b}\t{x.person_b}\t'
+            f'{x.shared}\t{x.jaccard:.4g}\n')
+
+def read_aliases(handle):
+    ''' read a table of aliases from an open file handle
+    '''
+    header = handle.readline().strip('\n').split('\t')
+    assert header == ALIAS_HEADER, f'not an alias table: {header}'
+    aliases = []
+    for line in handle:
+        a_study, a_person, b_study, b_person, shared, jaccard = line.strip('\n').split('\t')
+        aliases.append(Alias(a_study, a_person, b_study, b_person, int(shared),
+            float(jaccard)))
+    return aliases
@@ -0,0 +1,116 @@
+# persistent cache of reference genome sequence, so allele fixing doesn't need
+# to request the same regions from Ensembl on every run
+
+import sqlite3
+import time
+
+class SequenceCache:
+    ''' SQLite cache of reference sequence windows
+
+    Windows are keyed by (build, chrom, start, end), using 1-based inclusive
+    coordinates as for the Ensembl sequence endpoint. Requests for a region
+    inside any cached window are answered by slicing that window. Prefetched
+    windows can be long, so the cache is limited by total sequence length as
+    well as by window count. Once the cache holds more than max_entries windows
+    or max_bases of sequence, the least recently used windows are evicted, down
+    to 90% of both limits, so eviction doesn't run on every new window.
+    '''
+    # lookups between saving access times
+    COMMIT_EVERY = 1000
+    def __init__(self, path, max_entries=1000000, max_bases=250000000):
+        ''' initialize the class object
+
+        Args:
+            path: path to the SQLite database (created if it doesn't exist).
+                Use ':memory:' for a cache which only lasts for this run.
+            max_entries: maximum number of windows to keep
+            max_bases: maximum total length of sequence to keep
+        '''
+        self.max_entries = max_entries
+        self.max_bases = max_bases
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS sequence (
+            build TEXT, chrom TEXT, start INTEGER, end INTEGER, seq TEXT,
+            accessed REAL, PRIMARY KEY (build, chrom, start, end))''')
+        self.conn.commit()
+
+        # track the longest window, so sub-range lookups only need to check
+        # windows starting within that distance of the requested region
+        span = self.conn.execute('SELECT MAX(end - start) FROM sequence').fetchone()[0]
+        self.max_span = span or 0
+        self.uncommitted = 0
+        self.count, size = self.conn.execute('SELECT COUNT(*), ' \
+            'SUM(LENGTH(seq)) FROM sequence').fetchone()
+        self.size = size or 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *err):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __len__(self):
+        return self.count
+
+    def get(self, build, chrom, start, end):
+        ''' get sequence for a region, if a cached window covers it
+
+        Returns:
+            DNA sequence as str, or None if not cached
+        '''
+        chrom = str(chrom)
+        row = self.conn.execute('SELECT rowid, start, seq FROM sequence WHERE ' \
+            'build=? AND chrom=? AND start BETWEEN ? AND ? AND end>=? LIMIT 1',
+            (build, chrom, end - self.max_span, start, end)).fetchone()
+        if row is None:
+            return None
+        rowid, window_start, seq = row
+        self.conn.execute('UPDATE sequence SET accessed=? WHERE rowid=?',
+            (time.time(), rowid))
+        # save access times in batches, so the write transaction isn't held
+        # open, without committing on every lookup
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+        return seq[start - window_start:end - window_start + 1]
+
+    def store(self, build, chrom, start, end, seq):
+        ''' add a window of sequence to the cache, then evict if too large
+        '''
+        key = (build, str(chrom), start, end)
+        existing = self.conn.execute('SELECT LENGTH(seq) FROM sequence WHERE ' \
+            'build=? AND chrom=? AND start=? AND end=?', key).fetchone()
+        self.conn.execute('INSERT OR REPLACE INTO sequence VALUES (?, ?, ?, ?, ?, ?)',
+            key + (seq, time.time()))
+        self.count += existing is None
+        self.size += len(seq) - (existing[0] if existing else 0)
+        self.max_span = max(self.max_span, end - start)
+        self.evict()
+        self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def evict(self):
+        ''' drop the least recently used windows if the cache holds too many,
+        or too much sequence
+        '''
+        if self.count <= self.max_entries and self.size <= self.max_bases:
+            return
+        max_count = int(self.max_entries * 0.9)
+        max_size = int(self.max_bases * 0.9)
+        rows = self.conn.execute('SELECT rowid, LENGTH(seq) FROM sequence ' \
+            'ORDER BY accessed')
+        evict = []
+        for rowid, length in rows:
+            if self.count <= max_count and self.size <= max_size:
+                break
+            evict.append((rowid, ))
+            self.count -= 1
+            self.size -= length
+        self.conn.executemany('DELETE FROM sequence WHERE rowid=?', evict)
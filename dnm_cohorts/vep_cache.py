@@ -0,0 +1,119 @@
+# persistent cache of VEP annotations, so reruns only query Ensembl for
+# variants which haven't been annotated before
+
+import sqlite3
+import time
+
+class VepCache:
+    ''' on-disk SQLite cache of VEP consequences and gene symbols
+
+    Entries are keyed by (build, chrom, pos, ref, alt), and record the Ensembl
+    release they came from, so entries from an older release are treated as
+    missing. Entries also expire after a time-to-live, and once the cache holds
+    more than max_entries, the least recently used entries are evicted.
+    '''
+    # number of positions per lookup query, below the SQLite variable limit
+    BATCH_SIZE = 500
+    def __init__(self, path, ttl=90 * 24 * 3600, max_entries=5000000):
+        ''' initialize the class object
+
+        Args:
+            path: path to the SQLite database (created if it doesn't exist)
+            ttl: seconds before an entry expires
+            max_entries: maximum number of entries to keep
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS vep (
+            build TEXT, chrom TEXT, pos INTEGER, ref TEXT, alt TEXT,
+            consequence TEXT, symbol TEXT, release INTEGER, created REAL,
+            accessed REAL, PRIMARY KEY (build, chrom, pos, ref, alt))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS vep_accessed ON vep (accessed)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *err):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM vep').fetchone()[0]
+
+    def _key(self, var):
+        return (var.build, var.chrom, var.pos, str(var.ref), str(var.alt))
+
+    def lookup(self, variants, releases):
+        ''' annotate variants from the cache
+
+        Args:
+            variants: list of variants, with chrom, pos, ref, alt and build
+            releases: dict of current Ensembl release for each build
+
+        Returns:
+            list of variants which weren't in the cache (or whose entries were
+            stale), and still need annotating.
+        '''
+        # look variants up in batches of positions on each chromosome, rather
+        # than one query per variant
+        groups = {}
+        for var in variants:
+            groups.setdefault((var.build, var.chrom), set()).add(var.pos)
+
+        cached = {}
+        for (build, chrom), positions in groups.items():
+            positions = sorted(positions)
+            for i in range(0, len(positions), self.BATCH_SIZE):
+                batch = positions[i:i + self.BATCH_SIZE]
+                query = 'SELECT pos, ref, alt, consequence, symbol, release, ' \
+                    'created FROM vep WHERE build=? AND chrom=? AND pos IN ' \
+                    f'({", ".join("?" * len(batch))})'
+                for pos, ref, alt, *row in self.conn.execute(query, [build, chrom] + batch):
+                    cached[(build, chrom, pos, ref, alt)] = row
+
+        now = time.time()
+        missing = []
+        hits = []
+        for var in variants:
+            key = self._key(var)
+            if key not in cached:
+                missing.append(var)
+                continue
+            consequence, symbol, release, created = cached[key]
+            if release != releases.get(var.build) or created + self.ttl < now:
+                missing.append(var)
+                continue
+            var.consequence, var.symbol = consequence, symbol
+            hits.append((now, ) + key)
+
+        self.conn.executemany('UPDATE vep SET accessed=? WHERE build=? AND ' \
+            'chrom=? AND pos=? AND ref=? AND alt=?', hits)
+        self.conn.commit()
+        return missing
+
+    def store(self, variants, releases):
+        ''' add annotated variants to the cache, then evict if too large
+        '''
+        now = time.time()
+        rows = [self._key(x) + (x.consequence, x.symbol, releases.get(x.build),
+            now, now) for x in variants]
+        self.conn.executemany('INSERT OR REPLACE INTO vep VALUES ' \
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        ''' drop expired entries, then the least recently used entries if the
+        cache holds too many
+        '''
+        self.conn.execute('DELETE FROM vep WHERE created < ?',
+            (time.time() - self.ttl, ))
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.conn.execute('DELETE FROM vep WHERE rowid IN (SELECT rowid ' \
+                'FROM vep ORDER BY accessed LIMIT ?)', (excess, ))
+        self.conn.commit()